@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import datetime
+import hashlib
+import mmap
+import os
+import sqlite3
+import threading
+import zlib
+
+from settings import logging
+
+
+class HtmlArchive:
+    """
+    原始网页存档
+
+    网页内容zlib压缩后追加写入段文件(segments/*.seg)，按内容sha1去重(content-addressed)；
+    索引(index.db, sqlite)记录 url + 爬取日期 -> 内容摘要 -> 段文件偏移，读取时mmap段文件。
+    """
+
+    def __init__(self, root, segment_size=256 * 1024 * 1024, commit_every=200):
+        self.root = root
+        self.segment_size = segment_size
+        self.commit_every = commit_every
+        os.makedirs(os.path.join(root, 'segments'), exist_ok=True)
+
+        self._lock = threading.RLock()
+        self._pending = 0
+        self._maps = {}
+        self._conn = sqlite3.connect(os.path.join(root, 'index.db'), check_same_thread=False)
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS blobs (
+                digest TEXT PRIMARY KEY, segment INTEGER, offset INTEGER, length INTEGER);
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT, crawl_date TEXT, digest TEXT, PRIMARY KEY (url, crawl_date));
+        ''')
+        segment = self._conn.execute('SELECT max(segment) FROM blobs').fetchone()[0]
+        self._segment = segment or 0
+        self._writer = open(self._segment_path(self._segment), 'ab')
+
+    def _segment_path(self, segment):
+        return os.path.join(self.root, 'segments', '{:05d}.seg'.format(segment))
+
+    def write(self, url, content, crawl_date=None):
+        """ 存档一个网页 """
+        data = content.encode('utf-8')
+        digest = hashlib.sha1(data).hexdigest()
+        crawl_date = crawl_date or datetime.date.today().isoformat()
+
+        with self._lock:
+            exists = self._conn.execute('SELECT 1 FROM blobs WHERE digest = ?', (digest,)).fetchone()
+            if not exists:
+                blob = zlib.compress(data)
+                if self._writer.tell() and self._writer.tell() + len(blob) > self.segment_size:
+                    self._writer.close()
+                    self._segment += 1
+                    self._writer = open(self._segment_path(self._segment), 'ab')
+                offset = self._writer.tell()
+                self._writer.write(blob)
+                self._writer.flush()
+                self._conn.execute('INSERT INTO blobs VALUES (?, ?, ?, ?)',
+                                   (digest, self._segment, offset, len(blob)))
+            self._conn.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?)', (url, crawl_date, digest))
+
+            self._pending += 1
+            if self._pending >= self.commit_every:
+                self._conn.commit()
+                self._pending = 0
+
+    def read(self, url, crawl_date=None, **kwargs):
+        """
+        读取存档网页，crawl_date为空时取最新一次，否则取该日期及之前最近的一次
+        与request_data签名兼容，可直接作为request_fn使用
+        """
+        crawl_date = crawl_date or '9999-12-31'
+        with self._lock:
+            row = self._conn.execute('''
+                SELECT b.segment, b.offset, b.length FROM pages p
+                JOIN blobs b ON b.digest = p.digest
+                WHERE p.url = ? AND p.crawl_date <= ?
+                ORDER BY p.crawl_date DESC LIMIT 1
+            ''', (url, crawl_date)).fetchone()
+            if not row:
+                logging.info("Archive Miss - {0}".format(url))
+                return
+
+            segment, offset, length = row
+            buffer = self._maps.get(segment)
+            if buffer is None or offset + length > len(buffer):
+                if buffer is not None:
+                    buffer.close()
+                with open(self._segment_path(segment), 'rb') as f:
+                    buffer = self._maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return zlib.decompress(buffer[offset:offset + length]).decode('utf-8')
+
+    def urls(self, crawl_date=None):
+        """ 某一爬取日期(默认全部)存档的url """
+        with self._lock:
+            if crawl_date:
+                rows = self._conn.execute('SELECT url FROM pages WHERE crawl_date = ?', (crawl_date,))
+            else:
+                rows = self._conn.execute('SELECT DISTINCT url FROM pages')
+            return [x[0] for x in rows]
+
+    def crawl_dates(self):
+        return [x[0] for x in self._conn.execute('SELECT DISTINCT crawl_date FROM pages ORDER BY 1')]
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+            self._pending = 0
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+            self._writer.close()
+            for buffer in self._maps.values():
+                buffer.close()
+            self._maps = {}
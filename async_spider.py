@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+
+import aiohttp
+
+from metrics import metrics
+from settings import logging
+from spider import (PAGE_LIMIT, LianJiaSpider, parse_detail_page, parse_list_page, record_items, split_filters,
+                    timed_parse)
+from utils import get_header, get_proxy, is_blocked, limiter_key, rate_limiter, record_request, report_proxy
+
+
+class AsyncLianJiaSpider(LianJiaSpider):
+    """
+    链家二手房爬虫(asyncio版)
+
+    与LianJiaSpider用法一致，区别在于：
+    1）所有区县/搜索条件的列表页和详情页同时调度，不再逐个条件阻塞；
+    2）并发数由全局信号量concurrency控制，而非线程数；
+    3）解析和入库复用LianJiaSpider的parse_list_page/parse_detail_page/persist，
+       设置parse_workers后解析在进程池中执行，不阻塞事件循环。
+    """
+
+    def __init__(self, city, districts, concurrency=100, backend='bs4'):
+        super().__init__(city, districts, backend=backend)
+        self.concurrency = concurrency
+        self.delay = 0.5
+        self.retry = 2
+        self.timeout = 10
+        self.auto_proxy = False
+        self._semaphore = None
+
+    def set_request_params(self, max_workers, delay, retry=2, auto_proxy=False, concurrency=None):
+        """ 设置request参数 """
+        super().set_request_params(max_workers, delay, retry=retry, auto_proxy=auto_proxy)
+        self.delay = delay
+        self.retry = retry
+        self.auto_proxy = auto_proxy
+        if concurrency:
+            self.concurrency = concurrency
+
+    async def fetch(self, session, url):
+        """ 异步Get请求，受全局并发数和自适应限速器限制 """
+        if self.replay:
+            return self.replay(url)
+
+        loop = asyncio.get_event_loop()
+        async with self._semaphore:
+            for attempt in range(self.retry + 1):
+                proxy = None
+                if self.auto_proxy:
+                    with metrics.timer('proxy_select_seconds'):
+                        proxy = await loop.run_in_executor(None, get_proxy)
+                key = limiter_key(url, proxy)
+                if self.delay:
+                    with metrics.timer('rate_limit_wait_seconds', host=key[0]):
+                        await asyncio.sleep(rate_limiter.reserve(key, 1 / self.delay))
+
+                t0 = time.time()
+                try:
+                    async with session.get(url, headers=get_header(),
+                                           proxy=proxy and 'http://{}'.format(proxy)) as res:
+                        content = await res.text() if res.status == 200 else None
+                        record_request(key[0], res.status, time.time() - t0, len(await res.read()) if content else 0)
+                        blocked = content is not None and is_blocked(str(res.url), content)
+                        if content is not None and not blocked:
+                            logging.debug("Request Data - {0} - {1}".format(res.status, url))
+                            rate_limiter.feedback(key, True, time.time() - t0, res.status)
+                            report_proxy(proxy, True, time.time() - t0)
+                            if self.archive:
+                                self.archive.write(url, content)
+                            return content
+                        status = 'blocked' if blocked else res.status
+                        rate_limiter.feedback(key, False, time.time() - t0, status)
+                        report_proxy(proxy, False)
+                        logging.info("Request Data - {0} - {1}".format(status, url))
+                        return
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    record_request(key[0], type(e).__name__, time.time() - t0)
+                    rate_limiter.feedback(key, False, time.time() - t0, type(e).__name__)
+                    report_proxy(proxy, False)
+                    logging.error("Request ERROR: {0}, url: {1}, attempt: {2}".format(e, url, attempt + 1))
+
+    async def run_parse_async(self, fn, module, content):
+        """ 有解析进程池时在进程池中解析，否则直接在事件循环中解析 """
+        try:
+            if self.parse_pool:
+                result, cost = await asyncio.get_event_loop().run_in_executor(
+                    self.parse_pool, timed_parse, fn, self.parser, module, content)
+            else:
+                result, cost = timed_parse(fn, self.parser, module, content)
+        except Exception:
+            metrics.inc('parse_failures_total', module=module, stage=fn.__name__)
+            raise
+        metrics.observe('parse_seconds', cost, module=module, stage=fn.__name__)
+        return result
+
+    async def fetch_details_async(self, session, module, info_dict, key, page):
+        """ 请求并合并详情页 """
+        if module == 'sale_info' and self.load_cached_sale_details(info_dict):
+            return info_dict
+        content = await self.fetch(session, info_dict['link'])
+        if not content:
+            logging.error('@crawl_{0}: {1} - page - {2}: {3} - empty content.'.format(
+                module, key, page, info_dict['link']))
+            return
+        try:
+            details = await self.run_parse_async(parse_detail_page, module, content)
+        except Exception as e:
+            logging.exception('@crawl_{0}: {1} - page - {2}: {3} - {4}'.format(
+                module, key, page, info_dict['link'], e))
+            return
+        if module == 'sale_info' and self.detail_cache:
+            self.detail_cache.put(info_dict['house_id'], info_dict['total_price'], details)
+        info_dict.update(details)
+        logging.debug('@crawl_{0}: {1} - page - {2}: {3}'.format(module, key, page, info_dict))
+        return info_dict
+
+    async def crawl_page_async(self, session, module, url_page, key, page):
+        """ 爬取一页列表(含详情页)并入库 """
+        content = self.first_pages.pop(url_page, None) or await self.fetch(session, url_page)
+        if not content:
+            logging.error('@crawl_{0}: {1} - page - {2}: empty content.'.format(module, key, page))
+            return
+
+        try:
+            records, errors = await self.run_parse_async(parse_list_page, module, content)
+        except Exception as e:
+            logging.exception('@crawl_{0}: {1} - page - {2}: {3}'.format(module, key, page, e))
+            return
+        record_items(module, key, records, errors)
+        for error in errors:
+            logging.error('@crawl_{0}: {1} - page - {2}: {3}'.format(module, key, page, error))
+
+        if module != 'transaction_info':
+            records = await asyncio.gather(*[
+                self.fetch_details_async(session, module, info_dict, key, page) for info_dict in records
+            ])
+            records = [x for x in records if x]
+        await asyncio.get_event_loop().run_in_executor(None, self.persist, module, records, key)
+        logging.info('@crawl_{0}: {1} - page - {2} complete.'.format(module, key, page))
+
+    async def split_query_async(self, session, module, scope, key, filters=''):
+        """ 同LianJiaSpider.split_query，子查询的总页数并发查询 """
+        loop = asyncio.get_event_loop()
+        url = self.list_url(module, scope, key, page=1, filters=filters)
+        # 首次读取记录时查询数据库，放到线程池中避免阻塞事件循环
+        total_pages = await loop.run_in_executor(None, self.hinted_total_pages, module, scope, key, filters)
+        if total_pages is None:
+            content = await self.fetch(session, url)
+            total_pages = self.parse_total_pages(content) if content else 0
+            if content:
+                await loop.run_in_executor(None, self.hints.put, module, scope, key, filters, total_pages)
+            if total_pages:
+                self.first_pages[url] = content
+
+        children = split_filters(module, filters)
+        if total_pages < PAGE_LIMIT or not children:
+            return [(filters, total_pages)] if total_pages else []
+        self.first_pages.pop(url, None)
+        logging.info("@split_query: {0} - {1}{2} - {3} pages, split into {4}".format(
+            module, key, filters, total_pages, len(children)))
+        results = await asyncio.gather(*[
+            self.split_query_async(session, module, scope, key, child) for child in children
+        ])
+        return [x for result in results for x in result]
+
+    async def crawl_key_async(self, session, module, scope, key, max_pages):
+        """ 爬取单个区县/搜索条件的所有页，总页数达到上限时拆分查询 """
+        queries = await self.split_query_async(session, module, scope, key)
+        total_pages = sum(min(x[1], max_pages) for x in queries)
+        logging.info("@crawl_{0}: total {1} pages found for {2} in {3} queries".format(
+            module, total_pages, key, len(queries)))
+        if not total_pages:
+            return
+
+        await asyncio.gather(*[
+            self.crawl_page_async(session, module, self.list_url(module, scope, key, page + 1, filters),
+                                  key + filters, page + 1)
+            for filters, pages in queries for page in range(min(pages, max_pages))
+        ])
+        logging.info("@crawl_{0}: {1} - all {2} pages complete.".format(module, key, total_pages))
+
+    async def crawl_keys_async(self, module, scope, keys, max_pages):
+        """ 并发爬取多个区县/搜索条件 """
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            await asyncio.gather(*[
+                self.crawl_key_async(session, module, scope, key, max_pages) for key in keys
+            ])
+
+    def crawl_district_pool(self, module, max_pages=100):
+        """ 依据地区批量爬取 """
+        loop = asyncio.get_event_loop()
+        with self.crawl_context():
+            loop.run_until_complete(self.crawl_keys_async(module, 'district', self.districts, max_pages))
+
+    def crawl_search_pool(self, module, collection, max_pages=100, coll_start=1, incremental=False):
+        """ 依据商圈或小区批量爬取，增量模式需逐页判断是否停止，使用LianJiaSpider的实现 """
+        if incremental:
+            return super().crawl_search_pool(module, collection, max_pages, coll_start, incremental)
+        logging.info("@crawl_{0}: total {1} found".format(module, len(collection)))
+        loop = asyncio.get_event_loop()
+        with self.crawl_context():
+            loop.run_until_complete(self.crawl_keys_async(module, 'search', collection[coll_start - 1:], max_pages))
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+解析器性能对比：用存档网页分别运行 bs4 / lxml 两种解析器，比较耗时并校验结果一致
+
+python benchmark.py archive --date 2020-07-26 --repeat 3
+"""
+import argparse
+import re
+import time
+
+from archive import HtmlArchive
+from spider import PARSERS
+
+PAGE_TYPES = [
+    (re.compile(r'/ershoufang/\d+\.html'), 'sale_details'),
+    (re.compile(r'/xiaoqu/\d+/$'), 'community_details'),
+    (re.compile(r'/ershoufang/'), 'sale_info'),
+    (re.compile(r'/xiaoqu/'), 'community_info'),
+    (re.compile(r'/chengjiao/(?!\d+\.html)'), 'transaction_info'),
+]
+ITEM_PARSERS = {
+    'sale_info': 'sale_item',
+    'community_info': 'community_item',
+    'transaction_info': 'transaction_item',
+}
+
+
+def page_type(url):
+    for pattern, name in PAGE_TYPES:
+        if pattern.search(url):
+            return name
+
+
+def parse_page(parser, name, content):
+    """ 解析单个网页，返回解析结果列表 """
+    if name in ITEM_PARSERS:
+        item_parser = getattr(parser, ITEM_PARSERS[name])
+        results = []
+        for item_tag in parser.list_items(name, content):
+            try:
+                results.append(item_parser(item_tag))
+            except Exception as e:
+                results.append(repr(type(e)))
+        return results
+    try:
+        return [getattr(parser, name)(content)]
+    except Exception as e:
+        return [repr(type(e))]
+
+
+def run(backend, pages, repeat=1):
+    parser = PARSERS[backend]()
+    cost = {}
+    results = {}
+    for _ in range(repeat):
+        for url, name, content in pages:
+            t0 = time.perf_counter()
+            results[url] = parse_page(parser, name, content)
+            cost[name] = cost.get(name, 0) + time.perf_counter() - t0
+    return {k: v / repeat for k, v in cost.items()}, results
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('archive', help='HtmlArchive目录')
+    arg_parser.add_argument('--date', help='爬取日期，默认全部')
+    arg_parser.add_argument('--limit', type=int, default=0, help='最多使用的网页数')
+    arg_parser.add_argument('--repeat', type=int, default=1)
+    args = arg_parser.parse_args()
+
+    archive = HtmlArchive(args.archive)
+    urls = archive.urls(args.date)
+    if args.limit:
+        urls = urls[:args.limit]
+    pages = [(url, page_type(url), archive.read(url, args.date)) for url in urls]
+    pages = [x for x in pages if x[1] and x[2]]
+    archive.close()
+
+    counts = {}
+    for _, name, _ in pages:
+        counts[name] = counts.get(name, 0) + 1
+
+    bs4_cost, bs4_results = run('bs4', pages, args.repeat)
+    lxml_cost, lxml_results = run('lxml', pages, args.repeat)
+    diff = [url for url in bs4_results if bs4_results[url] != lxml_results[url]]
+
+    print('{:<20}{:>8}{:>12}{:>12}{:>10}'.format('page type', 'pages', 'bs4(s)', 'lxml(s)', 'speedup'))
+    for name in sorted(counts):
+        print('{:<20}{:>8}{:>12.3f}{:>12.3f}{:>9.1f}x'.format(
+            name, counts[name], bs4_cost[name], lxml_cost[name], bs4_cost[name] / max(lxml_cost[name], 1e-9)))
+    print('{:<20}{:>8}{:>12.3f}{:>12.3f}'.format(
+        'total', len(pages), sum(bs4_cost.values()), sum(lxml_cost.values())))
+    print('results identical: {0}/{1}'.format(len(pages) - len(diff), len(pages)))
+    for url in diff[:10]:
+        print('  diff: {}'.format(url))
+
+
+if __name__ == '__main__':
+    main()
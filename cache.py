@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import threading
+
+from model import SaleDetailCache, DBSession, BatchWriter, upsert
+from settings import logging
+
+# 详情页中挂牌后基本不变的字段，关注人数(follow)每天变化，不缓存
+STATIC_FIELDS = [
+    'district', 'top_image', 'layout_image', 'layout', 'inside_area', 'duplex', 'material',
+    'heating', 'ladder_ratio', 'has_ladder', 'put_date', 'trans_auth', 'last_date', 'usage',
+    'use_year', 'property_auth', 'mortgage', 'certificate',
+]
+
+
+class DetailCache:
+    """
+    在售房源详情页缓存，按house_id存储详情页静态字段
+
+    爬取开始时一次性加载未过期的缓存，命中条件：未过期且列表页总价与缓存时一致；
+    新写入的缓存批量upsert到sale_detail_cache表。
+    """
+
+    def __init__(self, ttl_days=30, batch_size=500):
+        self.ttl = datetime.timedelta(days=ttl_days)
+        self.writer = BatchWriter(upsert, batch_size=batch_size)
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """ 加载未过期的缓存 """
+        session = DBSession()
+        query = session.query(SaleDetailCache) \
+            .filter(SaleDetailCache.update_time >= datetime.datetime.now() - self.ttl) \
+            .yield_per(1000)
+        for x in query:
+            self._entries[x.house_id] = (x.total_price, x.update_time, json.loads(x.content))
+        session.close()
+        logging.info('@detail_cache: {0} entries loaded.'.format(len(self._entries)))
+        return self
+
+    def get(self, house_id, total_price):
+        """ 命中返回静态字段dict，否则返回None """
+        entry = self._entries.get(house_id)
+        hit = entry is not None \
+            and entry[0] == total_price \
+            and entry[1] >= datetime.datetime.now() - self.ttl
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return dict(entry[2]) if hit else None
+
+    def put(self, house_id, total_price, details):
+        now = datetime.datetime.now()
+        content = {x: details.get(x) for x in STATIC_FIELDS}
+        self._entries[house_id] = (total_price, now, content)
+        self.writer.add(SaleDetailCache, {
+            'house_id': house_id,
+            'total_price': total_price,
+            'content': json.dumps(content, ensure_ascii=False),
+            'update_time': now,
+        })
+
+    def flush(self):
+        self.writer.flush()
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': round(self.hit_rate, 4)}
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+在售房源变化事件：对比两次爬取，按区县计算新上架、下架、调价的房源，写入sale_events表
+
+python events.py 2020-07-19 2020-07-26 --source sale_snapshot
+"""
+import argparse
+import datetime
+
+from sqlalchemy import column, select, table
+
+from model import SaleEvent, get_engine
+from settings import logging
+
+# 数据来源：sale_info(每日全量) 或 sale_snapshot(增量存储的兼容视图)
+SOURCES = ['sale_info', 'sale_snapshot']
+
+
+def source_table(source):
+    return table(source, column('id'), column('house_id'), column('district'),
+                 column('total_price'), column('create_time'))
+
+
+def day_range(source, date):
+    next_date = date + datetime.timedelta(days=1)
+    return (source.c.create_time >= date.isoformat()) & (source.c.create_time < next_date.isoformat())
+
+
+def load_prices(conn, source, district, date):
+    """ 某区县某天的 house_id -> 总价，同一天多次爬取的取最后一次 """
+    query = select([source.c.house_id, source.c.total_price]) \
+        .where(day_range(source, date) & (source.c.district == district)) \
+        .order_by(source.c.id)
+    return {house_id: price for house_id, price in conn.execute(query)}
+
+
+def diff_prices(base, current):
+    """ :return: [(house_id, event, old_price, new_price), ...] """
+    events = [(x, 'new', None, current[x]) for x in current.keys() - base.keys()]
+    events += [(x, 'removed', base[x], None) for x in base.keys() - current.keys()]
+    events += [(x, 'repriced', base[x], current[x]) for x in current.keys() & base.keys() if base[x] != current[x]]
+    return events
+
+
+def detect_events(base_date, event_date, districts=None, source='sale_info'):
+    """
+    对比base_date和event_date两次爬取，逐个区县计算事件并覆盖写入sale_events
+    每次只加载一个区县两天的 house_id -> 总价，内存占用与单个区县的房源数成正比
+    """
+    source = source_table(source)
+    with get_engine().connect() as conn:
+        if not districts:
+            query = select([source.c.district]).distinct() \
+                .where(day_range(source, base_date) | day_range(source, event_date))
+            districts = sorted(x[0] for x in conn.execute(query))
+
+        summary = {}
+        for district in districts:
+            events = diff_prices(load_prices(conn, source, district, base_date),
+                                 load_prices(conn, source, district, event_date))
+            rows = [{
+                'event_date': event_date, 'base_date': base_date, 'house_id': house_id, 'district': district,
+                'event': event, 'old_price': old_price, 'new_price': new_price,
+            } for house_id, event, old_price, new_price in events]
+
+            with conn.begin():
+                conn.execute(SaleEvent.__table__.delete().where(
+                    (SaleEvent.event_date == event_date) & (SaleEvent.base_date == base_date)
+                    & (SaleEvent.district == district)))
+                for i in range(0, len(rows), 500):
+                    conn.execute(SaleEvent.__table__.insert(), rows[i:i + 500])
+
+            summary[district] = {x: sum(1 for e in events if e[1] == x) for x in ('new', 'removed', 'repriced')}
+            logging.info('@detect_events: {0} - {1} -> {2}: {3}'.format(
+                district, base_date, event_date, summary[district]))
+    return summary
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('base_date', help='对比的爬取日期')
+    arg_parser.add_argument('event_date', help='本次爬取日期')
+    arg_parser.add_argument('--district', action='append', help='区县，默认全部')
+    arg_parser.add_argument('--source', choices=SOURCES, default='sale_info')
+    args = arg_parser.parse_args()
+
+    base_date, event_date = [datetime.datetime.strptime(x, '%Y-%m-%d').date() for x in (args.base_date, args.event_date)]
+    detect_events(base_date, event_date, args.district, args.source)
+
+
+if __name__ == '__main__':
+    main()
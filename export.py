@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+增量导出Parquet：按id/create_time顺序分批流式读取，按日期分区写入Parquet文件，只导出上次导出水位线之后的新数据
+
+python export.py export --tables sale_info transaction_info
+读取：pd.read_parquet('export/sale_info')
+"""
+import argparse
+import datetime
+import json
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import Date, DateTime, Float, Integer, Numeric, and_, or_, select
+
+from model import SaleInfo, CommunityInfo, TransactionInfo, get_engine
+from settings import logging
+
+TABLES = {
+    'sale_info': SaleInfo,
+    'community_info': CommunityInfo,
+    'transaction_info': TransactionInfo,
+}
+
+# 取值较少的字段使用字典编码
+CATEGORICAL = {
+    'district', 'biz_circle', 'community', 'orient', 'decoration', 'layout', 'floor_level', 'structure',
+    'heating', 'usage', 'use_year', 'trans_auth', 'property_auth', 'duplex', 'material', 'has_ladder',
+}
+
+WATERMARK_FILE = '_watermark.json'
+
+
+def arrow_type(column):
+    if isinstance(column.type, Integer):
+        return pa.int64()
+    if isinstance(column.type, (Float, Numeric)):
+        return pa.float64()
+    if isinstance(column.type, DateTime):
+        return pa.timestamp('us')
+    if isinstance(column.type, Date):
+        return pa.date32()
+    return pa.string()
+
+
+def to_arrow(table, rows):
+    """ 按模型字段类型转换，保证各批次schema一致 """
+    arrays = []
+    for i, column in enumerate(table.columns):
+        values = [row[i] for row in rows]
+        if isinstance(column.type, Numeric) and not isinstance(column.type, Float):
+            values = [None if x is None else float(x) for x in values]
+        array = pa.array(values, type=arrow_type(column))
+        if column.name in CATEGORICAL:
+            array = array.dictionary_encode()
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, names=[x.name for x in table.columns])
+
+
+def load_watermarks(root):
+    path = os.path.join(root, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_watermarks(root, watermarks):
+    """ 先写临时文件再替换，避免中断时水位线文件损坏 """
+    path = os.path.join(root, WATERMARK_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(watermarks, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def export_table(root, name, chunk_size=50000):
+    """
+    导出一张表中水位线之后的数据
+    sale_info按自增id；community_info/transaction_info主键非自增，按(create_time, id)，已导出记录的更新不会再次导出
+    """
+    table = TABLES[name].__table__
+    watermarks = load_watermarks(root)
+    watermark = watermarks.get(name, {})
+
+    query = select([table]).where(table.c.create_time.isnot(None))
+    if name == 'sale_info':
+        order_by = [table.c.id]
+        if watermark:
+            query = query.where(table.c.id > watermark['id'])
+    else:
+        order_by = [table.c.create_time, table.c.id]
+        if watermark:
+            create_time = datetime.datetime.strptime(watermark['create_time'], '%Y-%m-%d %H:%M:%S.%f')
+            query = query.where(or_(
+                table.c.create_time > create_time,
+                and_(table.c.create_time == create_time, table.c.id > watermark['id'])))
+    query = query.order_by(*order_by)
+
+    create_time_index = [x.name for x in table.columns].index('create_time')
+    total = 0
+    with get_engine().connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(query)
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+
+            partitions = {}
+            for row in rows:
+                partitions.setdefault(row[create_time_index].date().isoformat(), []).append(row)
+            for date, partition_rows in partitions.items():
+                directory = os.path.join(root, name, f'date={date}')
+                os.makedirs(directory, exist_ok=True)
+                path = os.path.join(directory, 'part-{0}.parquet'.format(str(partition_rows[0]['id'])))
+                pq.write_table(to_arrow(table, partition_rows), path)
+
+            last = rows[-1]
+            watermarks[name] = {
+                'id': last['id'],
+                'create_time': last['create_time'].strftime('%Y-%m-%d %H:%M:%S.%f'),
+            }
+            save_watermarks(root, watermarks)
+            total += len(rows)
+            logging.info('@export: {0} - {1} rows exported, watermark: {2}'.format(name, total, watermarks[name]))
+    return total
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('root', help='导出目录')
+    arg_parser.add_argument('--tables', nargs='+', choices=list(TABLES), default=list(TABLES))
+    arg_parser.add_argument('--chunk-size', type=int, default=50000)
+    args = arg_parser.parse_args()
+
+    os.makedirs(args.root, exist_ok=True)
+    for name in args.tables:
+        export_table(args.root, name, args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
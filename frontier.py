@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+import datetime
+import os
+import socket
+
+from sqlalchemy import and_, func, or_
+
+from model import CrawlTask, DBSession, upsert_statement
+from settings import logging
+
+COLUMNS = [CrawlTask.id, CrawlTask.module, CrawlTask.scope, CrawlTask.search_key, CrawlTask.filters,
+           CrawlTask.page, CrawlTask.attempts]
+
+
+class Frontier:
+    """
+    持久化爬取任务队列
+
+    每个任务为一页列表：(crawl_date, module, scope, search_key, filters, page)，状态 pending -> running -> done/failed。
+    多个爬虫进程(可在不同机器上)通过租约领取任务：领取时写入lease_owner和lease_expiry，
+    租约过期未完成的任务可被重新领取，领取次数达到max_attempts后不再领取。
+    mysql8/postgresql使用 SELECT ... FOR UPDATE SKIP LOCKED，其他数据库(mysql5.7/sqlite)按条件UPDATE乐观领取。
+    """
+
+    def __init__(self, crawl_date=None, owner=None, lease_seconds=600, max_attempts=3):
+        self.crawl_date = crawl_date or datetime.date.today().isoformat()
+        self.owner = owner or '{0}-{1}'.format(socket.gethostname(), os.getpid())
+        self.lease = datetime.timedelta(seconds=lease_seconds)
+        self.max_attempts = max_attempts
+        self._skip_locked = None
+
+    def task_id(self, module, scope, search_key, filters, page):
+        return ':'.join([self.crawl_date, module, scope, search_key, filters, str(page)])
+
+    def seed(self, module, scope, search_keys, pages=(1,), filters=''):
+        """ 添加任务，已存在的任务保持原状态 """
+        rows = [{
+            'id': self.task_id(module, scope, search_key, filters, page), 'crawl_date': self.crawl_date,
+            'module': module, 'scope': scope, 'search_key': search_key, 'filters': filters, 'page': page,
+            'status': 'pending', 'attempts': 0, 'update_time': datetime.datetime.now(),
+        } for search_key in search_keys for page in pages]
+        if not rows:
+            return 0
+
+        session = DBSession()
+        try:
+            stmt = upsert_statement(CrawlTask.__table__, ['id'])
+            for i in range(0, len(rows), 500):
+                session.execute(stmt.values(rows[i:i + 500]))
+            session.commit()
+        finally:
+            session.close()
+        logging.debug('@frontier seed: {0} - {1} tasks'.format(module, len(rows)))
+        return len(rows)
+
+    def supports_skip_locked(self, session):
+        if self._skip_locked is None:
+            dialect = session.get_bind().dialect
+            if dialect.name == 'mysql':
+                session.execute('SELECT 1')
+                self._skip_locked = dialect.server_version_info >= (8,)
+            else:
+                self._skip_locked = dialect.name == 'postgresql'
+        return self._skip_locked
+
+    def claimable(self, now):
+        return and_(
+            CrawlTask.crawl_date == self.crawl_date,
+            CrawlTask.attempts < self.max_attempts,
+            or_(CrawlTask.status == 'pending',
+                and_(CrawlTask.status == 'running', CrawlTask.lease_expiry < now)))
+
+    def claim(self, limit=1):
+        """ 领取最多limit个任务 """
+        now = datetime.datetime.now()
+        values = {
+            'status': 'running', 'lease_owner': self.owner, 'lease_expiry': now + self.lease,
+            'attempts': CrawlTask.attempts + 1, 'update_time': now,
+        }
+        session = DBSession()
+        try:
+            query = session.query(CrawlTask.id).filter(self.claimable(now)).order_by(CrawlTask.id).limit(limit)
+            if self.supports_skip_locked(session):
+                ids = [x[0] for x in query.with_for_update(skip_locked=True)]
+                if ids:
+                    session.query(CrawlTask).filter(CrawlTask.id.in_(ids)) \
+                        .update(values, synchronize_session=False)
+            else:
+                ids = [x[0] for x in query]
+                ids = [x for x in ids if session.query(CrawlTask)
+                       .filter(CrawlTask.id == x, self.claimable(now))
+                       .update(values, synchronize_session=False)]
+            session.commit()
+            return session.query(*COLUMNS).filter(CrawlTask.id.in_(ids)).all() if ids else []
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def finish(self, task_id, status):
+        session = DBSession()
+        try:
+            session.query(CrawlTask) \
+                .filter(CrawlTask.id == task_id, CrawlTask.lease_owner == self.owner) \
+                .update({'status': status, 'lease_expiry': None, 'update_time': datetime.datetime.now()},
+                        synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+
+    def complete(self, task):
+        self.finish(task.id, 'done')
+
+    def fail(self, task, error=None):
+        """ 未达到max_attempts的任务放回队列 """
+        status = 'pending' if task.attempts < self.max_attempts else 'failed'
+        self.finish(task.id, status)
+        logging.error('@frontier fail: {0} - {1} - {2}'.format(task.id, status, error))
+
+    def active(self):
+        """ 可领取或正在执行(租约未过期)的任务数 """
+        now = datetime.datetime.now()
+        session = DBSession()
+        try:
+            return session.query(CrawlTask).filter(or_(
+                self.claimable(now),
+                and_(CrawlTask.crawl_date == self.crawl_date,
+                     CrawlTask.status == 'running', CrawlTask.lease_expiry >= now))).count()
+        finally:
+            session.close()
+
+    def stats(self):
+        session = DBSession()
+        try:
+            query = session.query(CrawlTask.status, func.count(CrawlTask.id)) \
+                .filter(CrawlTask.crawl_date == self.crawl_date) \
+                .group_by(CrawlTask.status)
+            return dict(query.all())
+        finally:
+            session.close()
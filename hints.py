@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import datetime
+import threading
+
+from model import CrawlHint, DBSession, upsert
+from settings import logging
+
+
+class CrawlHints:
+    """
+    列表查询(module, scope, search_key, filters)上次爬取时的总页数，及增量爬取的水位线
+
+    首次使用时一次性加载，新记录立即upsert到crawl_hint表；ttl_days内的记录视为新鲜。
+    """
+
+    def __init__(self, ttl_days=7):
+        self.ttl = datetime.timedelta(days=ttl_days)
+        self._hints = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def hint_id(module, scope, search_key, filters=''):
+        return ':'.join([module, scope, search_key, filters])
+
+    def load(self):
+        session = DBSession()
+        try:
+            self._hints = {x.id: {'total_pages': x.total_pages, 'watermark': x.watermark,
+                                  'backfill': x.backfill, 'update_time': x.update_time}
+                           for x in session.query(CrawlHint)}
+        finally:
+            session.close()
+        logging.info('@crawl_hints: {0} hints loaded.'.format(len(self._hints)))
+        return self
+
+    def hint(self, module, scope, search_key, filters=''):
+        with self._lock:
+            if self._hints is None:
+                self.load()
+        return self._hints.get(self.hint_id(module, scope, search_key, filters)) or {}
+
+    def get(self, module, scope, search_key, filters='', ttl=None):
+        """ 新鲜(默认ttl_days内)的总页数，没有或过期返回None """
+        hint = self.hint(module, scope, search_key, filters)
+        if hint.get('total_pages') is not None \
+                and hint['update_time'] >= datetime.datetime.now() - (ttl or self.ttl):
+            return hint['total_pages']
+
+    def get_watermark(self, module, scope, search_key, filters=''):
+        """ 增量爬取的水位线(已爬取的最新日期) """
+        return self.hint(module, scope, search_key, filters).get('watermark')
+
+    def put(self, module, scope, search_key, filters, total_pages):
+        self.save(module, scope, search_key, filters, total_pages=total_pages)
+
+    def put_watermark(self, module, scope, search_key, filters, watermark):
+        self.save(module, scope, search_key, filters, watermark=watermark)
+
+    def save(self, module, scope, search_key, filters, **values):
+        record = dict(values, **{
+            'id': self.hint_id(module, scope, search_key, filters), 'module': module, 'scope': scope,
+            'search_key': search_key, 'filters': filters, 'update_time': datetime.datetime.now(),
+        })
+        upsert(CrawlHint, [record])
+        with self._lock:
+            if self._hints is not None:
+                self._hints.setdefault(record['id'], {}).update(values, update_time=record['update_time'])
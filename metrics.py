@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import bisect
+import datetime
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from settings import logging
+
+# 延迟直方图的桶上界(秒)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(k, _escape(v)) for k, v in items) + '}'
+
+
+class Metrics:
+    """
+    爬取各阶段指标：计数器(counter)和延迟直方图(histogram)，按标签(module/key/host/status等)分别统计
+
+    * request_seconds / request_bytes_total / proxy_select_seconds / rate_limit_wait_seconds: 请求
+    * parse_seconds / parse_failures_total / items_parsed_total: 解析
+    * db_write_seconds(按module，批次内混合多个key) / rows_written_total / db_write_failures_total(按module/key): 入库
+    导出为Prometheus文本格式(prometheus()/serve(port))或JSON运行报告(report()/write_report(path))
+    """
+
+    def __init__(self, prefix='lianjia_', buckets=BUCKETS):
+        self.prefix = prefix
+        self.buckets = tuple(buckets)
+        self.started = time.time()
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """ 计数器加value """
+        key = self._key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """ 直方图记录一次观测值 """
+        key = self._key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            histogram['counts'][bisect.bisect_left(self.buckets, value)] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """ 记录代码块耗时 """
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - t0, **labels)
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+            self.started = time.time()
+
+    def quantile(self, histogram, q):
+        """ 按桶估计分位数(返回所在桶的上界) """
+        rank = q * histogram['count']
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), histogram['counts']):
+            total += count
+            if total >= rank and count:
+                return bound
+        return None
+
+    def report(self):
+        """ JSON运行报告 """
+        with self._lock:
+            counters = {name: dict(series) for name, series in self._counters.items()}
+            histograms = {name: {k: dict(v, counts=list(v['counts'])) for k, v in series.items()}
+                          for name, series in self._histograms.items()}
+
+        report = {
+            'started': datetime.datetime.fromtimestamp(self.started).isoformat(),
+            'elapsed': round(time.time() - self.started, 3),
+            'counters': {},
+            'histograms': {},
+        }
+        for name, series in counters.items():
+            report['counters'][name] = [dict(key, value=value) for key, value in series.items()]
+        for name, series in histograms.items():
+            report['histograms'][name] = [dict(
+                key,
+                count=x['count'],
+                sum=round(x['sum'], 6),
+                mean=round(x['sum'] / x['count'], 6) if x['count'] else None,
+                p50=self.quantile(x, 0.5),
+                p90=self.quantile(x, 0.9),
+                p99=self.quantile(x, 0.99),
+            ) for key, x in series.items()]
+        return report
+
+    def write_report(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=2, default=str)
+        logging.info('@metrics: report written to {0}'.format(path))
+
+    def prometheus(self):
+        """ Prometheus文本格式 """
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines.append('# TYPE {0}{1} counter'.format(self.prefix, name))
+                for key, value in series.items():
+                    lines.append('{0}{1}{2} {3}'.format(self.prefix, name, _format_labels(key), value))
+            for name, series in sorted(self._histograms.items()):
+                lines.append('# TYPE {0}{1} histogram'.format(self.prefix, name))
+                for key, x in series.items():
+                    total = 0
+                    for bound, count in zip(self.buckets + ('+Inf',), x['counts']):
+                        total += count
+                        lines.append('{0}{1}_bucket{2} {3}'.format(
+                            self.prefix, name, _format_labels(key, [('le', bound)]), total))
+                    lines.append('{0}{1}_sum{2} {3}'.format(self.prefix, name, _format_labels(key), x['sum']))
+                    lines.append('{0}{1}_count{2} {3}'.format(self.prefix, name, _format_labels(key), x['count']))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=9108, host='0.0.0.0'):
+        """ 后台线程启动HTTP服务，GET /metrics 返回Prometheus文本，GET /report 返回JSON报告 """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.startswith('/report'):
+                    body = json.dumps(metrics.report(), ensure_ascii=False, default=str).encode('utf-8')
+                    content_type = 'application/json; charset=utf-8'
+                else:
+                    body = metrics.prometheus().encode('utf-8')
+                    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = _ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        logging.info('@metrics: serving on {0}:{1}'.format(host, server.server_address[1]))
+        return server
+
+
+metrics = Metrics()
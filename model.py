@@ -1,9 +1,14 @@
 # -*- coding: utf-8 -*-
 import datetime
-from sqlalchemy import Column, String, Integer, Numeric, Float, DateTime, Index
+import threading
+import time
+from sqlalchemy import Column, String, Integer, Numeric, Float, Date, DateTime, Index, Sequence, Text
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.orm import Session, sessionmaker, scoped_session
+from sqlalchemy.sql.expression import Insert
 from settings import *
 
 Base = declarative_base()
@@ -12,9 +17,13 @@ Base = declarative_base()
 class SaleInfo(Base):
     """ 在售房源表 """
     __tablename__ = 'sale_info'
-    __table_args__ = {"mysql_charset": "utf8"}
+    __table_args__ = (
+        Index('ix_sale_info_district_create_time', 'district', 'create_time'),
+        Index('ix_sale_info_create_time', 'create_time'),
+        {"mysql_charset": "utf8"},
+    )
 
-    id = Column(Integer, primary_key=True, autoincrement=True)
+    id = Column(Integer, Sequence('sale_info_id_seq'), primary_key=True, autoincrement=True)
     house_id = Column(String(20), nullable=False, index=True, comment='链家房源ID')
     title = Column(String(50), nullable=False, comment='房源标题')
 
@@ -60,6 +69,135 @@ class SaleInfo(Base):
     create_time = Column(DateTime, default=datetime.datetime.now, comment='创建时间')
 
 
+class SaleListing(Base):
+    """ 在售房源维度表(增量存储)：每套房源一行，记录基本不变的属性 """
+    __tablename__ = 'sale_listing'
+    __table_args__ = {"mysql_charset": "utf8"}
+
+    house_id = Column(String(20), primary_key=True, comment='链家房源ID')
+    title = Column(String(50), nullable=False, comment='房源标题')
+
+    district = Column(String(20), index=True, comment='区县')
+    biz_circle = Column(String(20), nullable=False, comment='商圈')
+    community = Column(String(20), nullable=False, comment='小区')
+    community_id = Column(String(20), nullable=False, index=True, comment='小区ID')
+
+    put_date = Column(String(10), comment='挂牌时间')
+    area = Column(Float, nullable=False, comment='建筑面积')
+    inside_area = Column(Float, comment='套内面积')
+    tax_free_tag = Column(String(10), comment='满五免税标签')
+    subway_tag = Column(String(10), comment='临近地铁标签')
+    recommend_tag = Column(String(10), comment='推荐标签')
+
+    layout = Column(String(20), comment='户型')
+    orient = Column(String(10), comment='朝向')
+    decoration = Column(String(10), comment='装修')
+    floor_level = Column(String(10), comment='楼层高度')
+    total_floor = Column(Integer, comment='总楼层')
+    build_year = Column(String(4), comment='修建年份')
+    structure = Column(String(10), comment='建筑类型')
+    has_ladder = Column(String(10), comment='配备电梯')
+    ladder_ratio = Column(String(10), comment='梯户比')
+    heating = Column(String(10), comment='供暖方式')
+    trans_auth = Column(String(10), comment='交易权属')
+    property_auth = Column(String(10), comment='产权权属')
+    duplex = Column(String(10), comment='户型结构')
+    material = Column(String(10), comment='建筑结构')
+    usage = Column(String(10), comment='房屋用途')
+    use_year = Column(String(10), comment='房屋年限')
+    last_date = Column(String(10), comment='上次交易时间')
+    mortgage = Column(String(50), comment='抵押情况')
+    certificate = Column(String(50), comment='房本情况')
+
+    link = Column(String(200), comment='详情页链接')
+    top_image = Column(String(200), comment='首页实景图')
+    layout_image = Column(String(200), comment='户型图')
+
+    first_seen = Column(Date, default=datetime.date.today, comment='首次爬取日期')
+    last_seen = Column(Date, comment='最近爬取日期')
+
+
+class SaleObservation(Base):
+    """ 在售房源观测表(增量存储)：价格/关注人数不变且连续在售的爬取合并为一行[valid_from, valid_to] """
+    __tablename__ = 'sale_observation'
+    __table_args__ = (
+        Index('ix_sale_observation_house', 'house_id', 'valid_to'),
+        {"mysql_charset": "utf8"},
+    )
+
+    id = Column(Integer, Sequence('sale_observation_id_seq'), primary_key=True, autoincrement=True)
+    house_id = Column(String(20), nullable=False, comment='链家房源ID')
+    total_price = Column(Integer, nullable=False, comment='总价(万)')
+    unit_price = Column(Integer, nullable=False, comment='单价(元)')
+    follow = Column(Integer, comment='关注人数')
+    valid_from = Column(Date, nullable=False, comment='起始爬取日期')
+    valid_to = Column(Date, nullable=False, index=True, comment='最近爬取日期')
+
+
+class SaleCrawlDate(Base):
+    """ 在售房源各区县的爬取日期(增量存储)，用于判断观测是否连续及生成每日快照 """
+    __tablename__ = 'sale_crawl_date'
+    __table_args__ = {"mysql_charset": "utf8"}
+
+    crawl_date = Column(Date, primary_key=True, comment='爬取日期')
+    district = Column(String(20), primary_key=True, comment='区县')
+
+
+class SaleEvent(Base):
+    """ 在售房源变化事件：两次爬取之间新上架(new)、下架(removed)、调价(repriced)的房源 """
+    __tablename__ = 'sale_events'
+    __table_args__ = (
+        Index('ix_sale_events_district', 'event_date', 'district'),
+        {"mysql_charset": "utf8"},
+    )
+
+    event_date = Column(Date, primary_key=True, comment='本次爬取日期')
+    base_date = Column(Date, primary_key=True, comment='对比的爬取日期')
+    house_id = Column(String(20), primary_key=True, comment='链家房源ID')
+    district = Column(String(20), nullable=False, comment='区县')
+    event = Column(String(10), nullable=False, comment='new/removed/repriced')
+    old_price = Column(Integer, comment='对比日总价(万)')
+    new_price = Column(Integer, comment='本次总价(万)')
+
+
+class SaleRollup(Base):
+    """ 在售房源每日汇总：爬取日期 × 区县/商圈/小区 """
+    __tablename__ = 'sale_rollup'
+    __table_args__ = {"mysql_charset": "utf8"}
+
+    date = Column(Date, primary_key=True, comment='爬取日期')
+    level = Column(String(10), primary_key=True, comment='district/biz_circle/community')
+    district = Column(String(20), primary_key=True, comment='区县')
+    name = Column(String(20), primary_key=True, comment='区县/商圈/小区名')
+
+    listing_count = Column(Integer, comment='在售房源数')
+    total_price_median = Column(Float, comment='总价中位数(万)')
+    unit_price_median = Column(Float, comment='单价中位数(元)')
+    area_median = Column(Float, comment='建筑面积中位数')
+    recent_count = Column(Integer, comment='挂牌30天内在售房源数')
+    recent_total_price_median = Column(Float, comment='挂牌30天内总价中位数(万)')
+    recent_unit_price_median = Column(Float, comment='挂牌30天内单价中位数(元)')
+    recent_area_median = Column(Float, comment='挂牌30天内建筑面积中位数')
+
+
+class TransactionRollup(Base):
+    """ 历史成交每日汇总：成交日期 × 区县/商圈/小区 """
+    __tablename__ = 'transaction_rollup'
+    __table_args__ = {"mysql_charset": "utf8"}
+
+    date = Column(Date, primary_key=True, comment='成交日期')
+    level = Column(String(10), primary_key=True, comment='district/biz_circle/community')
+    district = Column(String(20), primary_key=True, comment='区县')
+    name = Column(String(20), primary_key=True, comment='区县/商圈/小区名')
+
+    deal_count = Column(Integer, comment='成交套数')
+    deal_price_median = Column(Float, comment='成交价中位数(万)')
+    unit_price_median = Column(Float, comment='成交单价中位数(元)')
+    area_median = Column(Float, comment='建筑面积中位数')
+    deal_period_median = Column(Float, comment='成交周期中位数(天)')
+    price_diff_median = Column(Float, comment='挂牌价-成交价中位数(万)')
+
+
 class CommunityInfo(Base):
     """ 社区表 """
     __tablename__ = 'community_info'
@@ -91,12 +229,15 @@ class CommunityInfo(Base):
 class TransactionInfo(Base):
     """ 历史成交纪录表 """
     __tablename__ = 'transaction_info'
-    __table_args__ = {"mysql_charset": "utf8"}
+    __table_args__ = (
+        Index('ix_transaction_info_community_deal_date', 'community', 'deal_date'),
+        {"mysql_charset": "utf8"},
+    )
 
     id = Column(String(30), primary_key=True)
     house_id = Column(String(20), nullable=False, index=True, comment='链家房源ID')
     # community_id = Column(String(20), index=True, comment='链家社区ID')
-    community = Column(String(20), index=True, comment='小区')
+    community = Column(String(20), comment='小区')
 
     deal_date = Column(String(10), comment='成交时间')
     deal_price = Column(Numeric, comment='成交价(万)')
@@ -117,18 +258,352 @@ class TransactionInfo(Base):
     create_time = Column(DateTime, default=datetime.datetime.now, comment='创建时间')
 
 
-engine = create_engine(
-    f'mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}?charset=utf8',
-    encoding='utf-8')
-DBSession = scoped_session(sessionmaker(bind=engine))
+class SaleDetailCache(Base):
+    """ 在售房源详情页缓存 """
+    __tablename__ = 'sale_detail_cache'
+    __table_args__ = {"mysql_charset": "utf8"}
+
+    house_id = Column(String(20), primary_key=True, comment='链家房源ID')
+    total_price = Column(Float, comment='缓存时的总价(万)')
+    content = Column(Text, comment='详情页静态字段(json)')
+    update_time = Column(DateTime, index=True, default=datetime.datetime.now, comment='缓存时间')
+
+
+class CrawlTask(Base):
+    """ 爬取任务队列(frontier)，支持多进程/多机器租约领取 """
+    __tablename__ = 'crawl_task'
+    __table_args__ = (
+        Index('ix_crawl_task_claim', 'crawl_date', 'status', 'lease_expiry'),
+        {"mysql_charset": "utf8"},
+    )
+
+    id = Column(String(120), primary_key=True, comment='crawl_date:module:scope:search_key:filters:page')
+    crawl_date = Column(String(10), nullable=False, comment='爬取批次(日期)')
+    module = Column(String(20), nullable=False, comment='sale_info/community_info/transaction_info')
+    scope = Column(String(10), nullable=False, comment='district/search')
+    search_key = Column(String(50), nullable=False, comment='区县或搜索条件')
+    filters = Column(String(30), nullable=False, default='', comment='筛选条件，如p3a2')
+    page = Column(Integer, nullable=False, comment='页码')
+
+    status = Column(String(10), nullable=False, default='pending', comment='pending/running/done/failed')
+    lease_owner = Column(String(100), comment='领取者')
+    lease_expiry = Column(DateTime, comment='租约到期时间')
+    attempts = Column(Integer, nullable=False, default=0, comment='领取次数')
+    update_time = Column(DateTime, default=datetime.datetime.now, comment='更新时间')
+
+
+class CrawlHint(Base):
+    """ 列表查询的总页数记录，用于跳过重复的总页数查询 """
+    __tablename__ = 'crawl_hint'
+    __table_args__ = {"mysql_charset": "utf8"}
+
+    id = Column(String(200), primary_key=True, comment='module:scope:search_key:filters')
+    module = Column(String(20), nullable=False, index=True)
+    scope = Column(String(10), nullable=False, comment='district/search')
+    search_key = Column(String(50), nullable=False, comment='区县或搜索条件')
+    filters = Column(String(30), nullable=False, default='', comment='筛选条件，如p3a2')
+    total_pages = Column(Integer, comment='总页数')
+    watermark = Column(String(10), comment='已爬取的最新成交日期(增量爬取)')
+    backfill = Column(Integer, default=0, comment='增量爬取有失败页，下次爬到水位线日期为止，不因已入库提前停止')
+    update_time = Column(DateTime, default=datetime.datetime.now, comment='更新时间')
+
+
+class LazyEngine:
+    """
+    首次使用时才按URL创建engine，import时不连接数据库
+    sqlite允许多线程共用连接；duckdb需安装duckdb_engine
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self._engine = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._engine is None:
+            with self._lock:
+                if self._engine is None:
+                    self._engine = self.create(self.url)
+        return self._engine
+
+    def set(self, url_or_engine):
+        """ 切换数据库，参数为URL或已创建的engine """
+        with self._lock:
+            if self._engine is not None:
+                self._engine.dispose()
+            if isinstance(url_or_engine, str):
+                self.url, self._engine = url_or_engine, None
+            else:
+                self.url, self._engine = str(url_or_engine.url), url_or_engine
+
+    @classmethod
+    def create(cls, url):
+        if url.startswith('sqlite'):
+            return create_engine(url, connect_args={'check_same_thread': False})
+        if url.startswith('mysql'):
+            return create_engine(url, encoding='utf-8')
+        return create_engine(url)
+
+
+class LazySession(Session):
+    """ 执行时才从LazyEngine取engine """
+
+    def __init__(self, lazy_engine=None, **kwargs):
+        super().__init__(**kwargs)
+        self.lazy_engine = lazy_engine
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        return self.lazy_engine.get()
+
+
+db_engine = LazyEngine(DB_URL)
+DBSession = scoped_session(sessionmaker(class_=LazySession, lazy_engine=db_engine))
+
+
+def get_engine():
+    return db_engine.get()
+
+
+def set_engine(url_or_engine):
+    """ 切换数据库(如单机/测试使用sqlite:///house.db)，需在爬取前调用 """
+    DBSession.remove()
+    db_engine.set(url_or_engine)
+
+
+class OnConflictUpsert(Insert):
+    """ sqlite/duckdb: INSERT ... ON CONFLICT DO UPDATE """
+
+    def __init__(self, table, index_elements, update_columns):
+        super().__init__(table)
+        self.index_elements = index_elements
+        self.update_columns = update_columns
+
+
+@compiles(OnConflictUpsert, 'sqlite')
+@compiles(OnConflictUpsert, 'duckdb')
+def compile_on_conflict_upsert(insert, compiler, **kw):
+    quote = compiler.preparer.quote
+    sql = compiler.visit_insert(insert, **kw)
+    if not insert.update_columns:
+        return sql + ' ON CONFLICT DO NOTHING'
+    return sql + ' ON CONFLICT ({0}) DO UPDATE SET {1}'.format(
+        ', '.join(quote(x) for x in insert.index_elements),
+        ', '.join('{0} = excluded.{0}'.format(quote(x)) for x in insert.update_columns))
+
+
+def upsert_statement(table, keys, engine=None):
+    """ 按方言生成 插入或按主键更新 语句，engine默认为db_engine """
+    primary_keys = [x.name for x in table.primary_key.columns]
+    update_columns = [x for x in keys if x not in primary_keys]
+
+    if (engine or get_engine()).dialect.name in ('sqlite', 'duckdb'):
+        return OnConflictUpsert(table, primary_keys, update_columns)
+
+    stmt = mysql_insert(table)
+    update_columns = update_columns or primary_keys
+    return stmt.on_duplicate_key_update({x: stmt.inserted[x] for x in update_columns})
+
+
+def upsert(model, records, batch_size=500, engine=None):
+    """
+    批量upsert：mysql为多行 INSERT ... ON DUPLICATE KEY UPDATE，sqlite/duckdb为 ON CONFLICT DO UPDATE
+    每条记录只更新其包含的字段，字段集合不同的记录分组执行；engine默认为db_engine(代理池表需传入proxy_engine)
+    """
+    engine = engine or get_engine()
+    groups = {}
+    for record in records:
+        groups.setdefault(tuple(sorted(record)), []).append(record)
+
+    with engine.begin() as conn:
+        for keys, rows in groups.items():
+            stmt = upsert_statement(model.__table__, keys, engine)
+            for i in range(0, len(rows), batch_size):
+                conn.execute(stmt.values(rows[i:i + batch_size]))
+    return len(records)
+
+
+def bulk_insert(model, records, batch_size=500):
+    """
+    Core层批量插入(executemany)，跳过ORM对象构建和identity map，适用于只追加的快照表
+    缺失字段补None，未指定create_time的记录统一使用本批次时间
+    """
+    table = model.__table__
+    columns = [x.name for x in table.columns if not (x.primary_key and x.autoincrement is True)]
+    now = datetime.datetime.now()
+
+    rows = []
+    for record in records:
+        row = {x: record.get(x) for x in columns}
+        if 'create_time' in row and row['create_time'] is None:
+            row['create_time'] = now
+        rows.append(row)
+
+    t0 = time.time()
+    with get_engine().begin() as conn:
+        for i in range(0, len(rows), batch_size):
+            conn.execute(table.insert(), rows[i:i + batch_size])
+    cost = time.time() - t0
+    logging.info('@bulk_insert: {0} - {1} rows, {2:.0f} rows/s'.format(
+        table.name, len(rows), len(rows) / cost if cost else 0))
+    return len(rows)
+
+
+class BatchWriter:
+    """ 线程安全的写入缓冲区，按key攒够batch_size条后调用write_fn(key, records)批量写入 """
+
+    def __init__(self, write_fn, batch_size=500):
+        self.write_fn = write_fn
+        self.batch_size = batch_size
+        self._records = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, record):
+        self.extend(key, [record])
+
+    def extend(self, key, records):
+        with self._lock:
+            buffer = self._records.setdefault(key, [])
+            buffer.extend(records)
+            if len(buffer) < self.batch_size:
+                return
+            self._records[key] = []
+        self.write_fn(key, buffer)
+
+    def flush(self):
+        with self._lock:
+            all_records, self._records = self._records, {}
+        for key, records in all_records.items():
+            if records:
+                self.write_fn(key, records)
+
+
+def sale_snapshot_view_sql():
+    """ 兼容视图sale_snapshot：由增量存储还原与sale_info相同字段的每日快照(每天每套房源一行) """
+    observed = {'id': 'o.id', 'total_price': 'o.total_price', 'unit_price': 'o.unit_price',
+                'follow': 'o.follow', 'create_time': 'c.crawl_date'}
+    columns = ', '.join('{0} AS {1}'.format(observed.get(x.name, 'l.' + x.name), x.name)
+                        for x in SaleInfo.__table__.columns)
+    create = 'CREATE VIEW IF NOT EXISTS' if get_engine().dialect.name == 'sqlite' else 'CREATE OR REPLACE VIEW'
+    return f"""
+        {create} sale_snapshot AS
+        SELECT {columns}
+        FROM sale_observation o
+        JOIN sale_listing l ON l.house_id = o.house_id
+        JOIN sale_crawl_date c ON c.district = l.district
+         AND c.crawl_date >= o.valid_from AND c.crawl_date <= o.valid_to
+    """
+
+
+def create_missing_indexes():
+    """ 为已存在的表补建模型中新增的索引(duckdb不支持索引反射，跳过) """
+    engine = get_engine()
+    if engine.dialect.name == 'duckdb':
+        return
+    inspector = inspect(engine)
+    tables = inspector.get_table_names()
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {x['name'] for x in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+                logging.info('@create_missing_indexes: {0}'.format(index.name))
+
+
+def month_start(date, offset=0):
+    """ date所在月份之后第offset个月的1号 """
+    month = date.year * 12 + date.month - 1 + offset
+    return datetime.date(month // 12, month % 12 + 1, 1)
+
+
+def partition_definitions(start, end):
+    """ [start, end)之间每月一个分区 """
+    definitions = []
+    month = start
+    while month < end:
+        next_month = month_start(month, 1)
+        definitions.append("PARTITION p{0} VALUES LESS THAN (TO_DAYS('{1}'))".format(month.strftime('%Y%m'), next_month))
+        month = next_month
+    return definitions
+
+
+def sale_info_partitions():
+    """ sale_info现有的分区，非mysql或未分区时为空 """
+    if get_engine().dialect.name != 'mysql':
+        return []
+    with get_engine().connect() as conn:
+        rows = conn.execute(
+            "SELECT partition_name FROM information_schema.partitions "
+            "WHERE table_schema = DATABASE() AND table_name = 'sale_info' AND partition_name IS NOT NULL")
+        return sorted(x[0] for x in rows)
+
+
+def partition_sale_info(months_ahead=3):
+    """
+    sale_info按爬取月份RANGE分区(仅mysql，只需执行一次)
+    分区键需包含在主键中，主键改为(id, create_time)；分区从最早数据所在月份至当前月份之后months_ahead个月，另有pmax兜底
+    """
+    if get_engine().dialect.name != 'mysql' or sale_info_partitions():
+        return
+    with get_engine().begin() as conn:
+        first = conn.execute('SELECT MIN(create_time) FROM sale_info').scalar() or datetime.datetime.now()
+        definitions = partition_definitions(month_start(first), month_start(datetime.date.today(), months_ahead + 1))
+        conn.execute('ALTER TABLE sale_info MODIFY create_time DATETIME NOT NULL, '
+                     'DROP PRIMARY KEY, ADD PRIMARY KEY (id, create_time)')
+        conn.execute('ALTER TABLE sale_info PARTITION BY RANGE (TO_DAYS(create_time)) '
+                     '({0}, PARTITION pmax VALUES LESS THAN MAXVALUE)'.format(', '.join(definitions)))
+    logging.info('@partition_sale_info: {0} partitions'.format(len(definitions)))
+
+
+def add_partitions(months_ahead=3):
+    """ 从pmax中拆分出至当前月份之后months_ahead个月的分区 """
+    partitions = [x for x in sale_info_partitions() if x != 'pmax']
+    if not partitions:
+        return
+    last = datetime.datetime.strptime(partitions[-1], 'p%Y%m').date()
+    definitions = partition_definitions(month_start(last, 1), month_start(datetime.date.today(), months_ahead + 1))
+    if not definitions:
+        return
+    with get_engine().begin() as conn:
+        conn.execute('ALTER TABLE sale_info REORGANIZE PARTITION pmax INTO '
+                     '({0}, PARTITION pmax VALUES LESS THAN MAXVALUE)'.format(', '.join(definitions)))
+    logging.info('@add_partitions: {0}'.format(len(definitions)))
+
+
+def drop_partitions(keep_months):
+    """ 删除keep_months个月之前的分区(数据一并删除) """
+    cutoff = 'p' + month_start(datetime.date.today(), -keep_months).strftime('%Y%m')
+    expired = [x for x in sale_info_partitions() if x != 'pmax' and x < cutoff]
+    if not expired:
+        return
+    with get_engine().begin() as conn:
+        conn.execute('ALTER TABLE sale_info DROP PARTITION {0}'.format(', '.join(expired)))
+    logging.info('@drop_partitions: {0}'.format(', '.join(expired)))
+
+
+def migrate_db(months_ahead=3, keep_months=None):
+    """ 补建索引，添加未来月份的分区，keep_months不为空时删除过期分区；适合每月定时执行 """
+    create_missing_indexes()
+    add_partitions(months_ahead)
+    if keep_months:
+        drop_partitions(keep_months)
 
 
-def init_db():
-    Base.metadata.create_all(engine)
+def init_db(partition=False):
+    """ partition: sale_info按月分区(仅mysql) """
+    Base.metadata.create_all(get_engine())
+    with get_engine().begin() as conn:
+        conn.execute(sale_snapshot_view_sql())
+    create_missing_indexes()
+    if partition:
+        partition_sale_info()
 
 
 def drop_db():
-    Base.metadata.drop_all(engine)
+    with get_engine().begin() as conn:
+        conn.execute('DROP VIEW IF EXISTS sale_snapshot')
+    Base.metadata.drop_all(get_engine())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import queue
+import threading
+
+from settings import logging
+
+
+class DetailPipeline:
+    """
+    详情页流水线
+
+    列表页任务将解析好的条目(含详情页链接)放入有界队列，
+    独立的详情页线程池从队列中取出、请求并解析详情页，合并后交给sink入库。
+    队列满时put阻塞，列表页任务随之减速(背压)。
+    """
+
+    def __init__(self, fetch_fn, workers=8, maxsize=200):
+        self.fetch_fn = fetch_fn
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'detail-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def put(self, record, parse_fn, sink):
+        """
+        :param record: 列表页解析结果，需包含link
+        :param parse_fn: 详情页解析函数，content -> dict
+        :param sink: 合并后的记录回调
+        """
+        self._queue.put((record, parse_fn, sink))
+
+    def close(self):
+        """ 等待队列清空后结束所有线程 """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                self._queue.task_done()
+                break
+
+            record, parse_fn, sink = task
+            try:
+                content = self.fetch_fn(record['link'])
+                if not content:
+                    logging.error('@detail_pipeline: {0} - empty content.'.format(record['link']))
+                    continue
+                record.update(parse_fn(content))
+                sink(record)
+            except Exception as e:
+                logging.exception('@detail_pipeline: {0} - {1}'.format(record.get('link'), e))
+            finally:
+                self._queue.task_done()
@@ -1,23 +1,25 @@
 # -*- coding: utf-8 -*-
 import datetime
+import random
 import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from warnings import filterwarnings
 
 import requests
 from bs4 import BeautifulSoup
 from sqlalchemy import Column, String, Integer, DateTime
-from sqlalchemy import create_engine
+from sqlalchemy import case
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, scoped_session
 
+from model import LazyEngine, LazySession, upsert
 from settings import *
 
 filterwarnings("ignore")
-engine = create_engine(
-    f'mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/proxy?charset=utf8',
-    encoding='utf-8')
-DBSession = scoped_session(sessionmaker(bind=engine))
+proxy_engine = LazyEngine(PROXY_DB_URL)
+DBSession = scoped_session(sessionmaker(class_=LazySession, lazy_engine=proxy_engine))
 Base = declarative_base()
 
 
@@ -34,11 +36,61 @@ class Proxy(Base):
     update_time = Column(DateTime, index=True, default=datetime.datetime.now)
 
 
+HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+                         '(KHTML, like Gecko) Chrome/83.0.4103.116 Safari/537.36'}
+
+
+class ProxySource:
+    """
+    免费代理来源，新增来源网站时继承并实现以下方法
+    """
+    name = None
+
+    def index_urls(self, pages=1, offset=0):
+        """ 来源列表页 """
+        raise NotImplementedError
+
+    def thread_urls(self, content):
+        """ 列表页中的详情页 [(url, title), ...]，代理直接列在列表页时返回空 """
+        return []
+
+    def extract(self, content):
+        """ 从网页中提取候选代理 [{'ip', 'cate', 'level', 'source'}, ...] """
+        raise NotImplementedError
+
+
+class ZdayeSource(ProxySource):
+    """ 站大爷每日代理 """
+    name = 'zdaye'
+    base_url = 'https://www.zdaye.com'
+
+    def index_urls(self, pages=1, offset=0):
+        return [f"{self.base_url}/dayProxy/{page}.html" for page in range(offset + 1, pages + 1)]
+
+    def thread_urls(self, content):
+        soup = BeautifulSoup(content, 'lxml')
+        return [(self.base_url + x.a.get('href'), x.a.get_text())
+                for x in soup.find_all("h3", class_="thread_title")]
+
+    def extract(self, content):
+        cont = BeautifulSoup(content, 'lxml').find("div", class_="cont")
+        if not cont:
+            return
+        for data in cont.strings:
+            if '@HTTP' not in data:
+                continue
+            level = re.search(r'\[(.+?)\]', data)
+            yield {
+                'ip': data.split('@HTTP')[0].strip(), 'cate': 'HTTP',
+                'level': level.group(1) if level else None, 'source': self.name
+            }
+
+
 class ProxyPool:
-    """ 自定义代理池，使用mysql存储 """
+    """ 自定义代理池，存储在PROXY_DB_URL(默认mysql的proxy库) """
 
     def __init__(self):
-        Base.metadata.create_all(engine)
+        Base.metadata.create_all(proxy_engine.get())
 
     @classmethod
     def is_valid_proxy(cls, proxy, cate='http', url='http://icanhazip.com', timeout=10):
@@ -64,71 +116,156 @@ class ProxyPool:
         return ip[:len(host)] == host
 
     def download_proxies_from_zdaye(self, pages=1, offset=0):
+        self.ingest([ZdayeSource()], pages=pages, offset=offset)
+
+    @staticmethod
+    def fetch_source(url):
+        try:
+            res = requests.get(url, headers=HEADERS, verify=False, timeout=10)
+            logging.info("Requests - {0} - {1}".format(res.status_code, url))
+            if res.status_code == 200:
+                return res.text
+        except requests.exceptions.RequestException as e:
+            logging.error("Requests ERROR: {0}, url: {1}".format(e, url))
+
+    def ingest(self, sources, pages=1, offset=0, fetch_workers=8, parallelism=50, timeout=10, batch_size=200):
+        """
+        流式导入免费代理：抓取来源网页 -> 提取候选代理 -> 内存去重 -> 并发验证 -> 批量入库
+        :param sources: ProxySource列表
+        """
         session = DBSession()
-        for page in range(offset + 1, pages + 1):
-            src_url = f"https://www.zdaye.com/dayProxy/{page}.html"
-            logging.info('@download_proxies_from_zdaye: page {0}/{1} - url - {2}'.format(page, pages, src_url))
-            content = requests.get(src_url, verify=False).text
-            soup = BeautifulSoup(content, 'lxml')
-
-            for item_tag in soup.find_all("h3", class_="thread_title"):
-                url = "https://www.zdaye.com" + item_tag.a.get('href')
-                title = item_tag.a.get_text()
-                logging.info("@download_proxies: {0} - {1}".format(url, title))
-
-                code = requests.get(src_url, verify=False).text
-                details = BeautifulSoup(code, 'lxml')
-                for data in details.find("div", class_="cont").contents:
-                    if '@HTTP' in data:
-                        ip = data.split('@HTTP')[0]
-                        level = re.search(r'\[.+\]', data)
-                        level = level.group() if level[1:-1] else None
-                        if not self.is_valid_proxy(ip):
-                            continue
-                        try:
-                            query = session.query(Proxy).filter(Proxy.ip == ip)
-                            if not query.first():
-                                session.add(Proxy(
-                                    ip=ip, is_valid=1, cate='http',
-                                    level=level, source='zdaye'))
-                                session.commit()
-                                logging.info(
-                                    '@download_proxies: host: {0}, level: {1}, source: zdaye'.format(ip, level))
-                        except Exception as e:
-                            session.rollback()
-                            logging.exception('@download_proxies: ERROR: {0}, ip: {1}'.format(e, ip))
-                    time.sleep(5)
+        known = {x[0] for x in session.query(Proxy.ip)}
         session.close()
 
-    def add_proxy(self, proxy_list):
+        fetcher = ThreadPoolExecutor(max_workers=fetch_workers)
+        validator = ThreadPoolExecutor(max_workers=parallelism)
+        validations = {}
+
+        def extract(source, content):
+            for params in source.extract(content):
+                if params['ip'] in known:
+                    continue
+                known.add(params['ip'])
+                validations[validator.submit(self.is_valid_proxy, params['ip'], timeout=timeout)] = params
+
+        def crawl(source, url):
+            return source, url, self.fetch_source(url)
+
+        index_pages = [fetcher.submit(crawl, source, url)
+                       for source in sources for url in source.index_urls(pages, offset)]
+        thread_pages = []
+        for future in as_completed(index_pages):
+            source, url, content = future.result()
+            if not content:
+                continue
+            extract(source, content)
+            for thread_url, title in source.thread_urls(content):
+                logging.info("@ingest: {0} - {1}".format(thread_url, title))
+                thread_pages.append(fetcher.submit(crawl, source, thread_url))
+        for future in as_completed(thread_pages):
+            source, url, content = future.result()
+            if content:
+                extract(source, content)
+        fetcher.shutdown()
+        logging.info("@ingest: {0} candidates found".format(len(validations)))
+
+        batch, count = [], 0
+        for future in as_completed(validations):
+            if future.exception() is None and future.result():
+                batch.append(dict(validations[future], is_valid=1))
+            if len(batch) >= batch_size:
+                count += self.insert_proxies(batch)
+                batch = []
+        count += self.insert_proxies(batch)
+        validator.shutdown()
+        logging.info("@ingest: {0} valid proxies added".format(count))
+
+    @classmethod
+    def insert_proxies(cls, proxies):
+        """ 批量入库，已存在的ip(如多个来源同时发现)更新为本次的结果 """
+        proxies = list({x['ip']: x for x in proxies}.values())
+        if not proxies:
+            return 0
+        try:
+            return upsert(Proxy, proxies, engine=proxy_engine.get())
+        except Exception as e:
+            logging.exception('@insert_proxies ERROR: {0}'.format(e))
+            return 0
+
+    @classmethod
+    def validate_many(cls, ips, parallelism=50, deadline=60, timeout=10):
+        """
+        并发验证代理ip
+        :param parallelism: 并发线程数
+        :param deadline: 本轮验证的截止时间(秒)，超时未完成的不在结果中(状态不变，下一轮再验证)
+        :return: {ip: 是否有效}
+        """
+        ips = list(set(ips))
+        if not ips:
+            return {}
+        executor = ThreadPoolExecutor(max_workers=min(parallelism, len(ips)))
+        futures = {executor.submit(cls.is_valid_proxy, ip, timeout=timeout): ip for ip in ips}
+        done, not_done = wait(futures, timeout=deadline)
+        for future in not_done:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+        result = {futures[f]: f.exception() is None and f.result() for f in done}
+        logging.info('@validate_many: {0}/{1} valid, {2} timeout'.format(
+            sum(result.values()), len(ips), len(not_done)))
+        return result
+
+    @classmethod
+    def apply_results(cls, result):
+        """ 验证结果单条UPDATE批量写回 """
+        if not result:
+            return
+        valid = [ip for ip, ok in result.items() if ok]
+        session = DBSession()
+        try:
+            session.query(Proxy) \
+                .filter(Proxy.ip.in_(list(result))) \
+                .update({'is_valid': case([(Proxy.ip.in_(valid), 1)], else_=0) if valid else 0},
+                        synchronize_session=False)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logging.exception('@apply_results ERROR: {0}'.format(e))
+        finally:
+            session.close()
+
+    def add_proxy(self, proxy_list, parallelism=50, deadline=60):
         """ 手动添加 """
+        result = self.validate_many([x['ip'] for x in proxy_list], parallelism=parallelism, deadline=deadline)
         session = DBSession()
-        for params in proxy_list:
-            ip = params['ip']
-            if not self.is_valid_proxy(ip):
-                logging.info('@add_proxy invalid ip: {0}'.format(ip))
-                continue
-            params['is_valid'] = 1
-            try:
-                query = session.query(Proxy).filter(Proxy.ip == ip)
-                if not query.first():
-                    session.add(Proxy(**params))
-                    session.commit()
-                    logging.info(
-                        '@add_proxy success - ip: {0}'.format(ip))
-            except Exception as e:
-                session.rollback()
-                logging.exception('@add_proxy ERROR: {0}, ip: {1}'.format(e, ip))
-        session.close()
+        try:
+            exists = {x[0] for x in session.query(Proxy.ip).filter(Proxy.ip.in_(list(result)))}
+            proxies = {}
+            for params in proxy_list:
+                ip = params['ip']
+                if ip not in result:
+                    logging.info('@add_proxy unchecked ip (deadline exceeded): {0}'.format(ip))
+                elif not result[ip]:
+                    logging.info('@add_proxy invalid ip: {0}'.format(ip))
+                elif ip not in exists:
+                    proxies[ip] = Proxy(**dict(params, is_valid=1))
+            session.add_all(proxies.values())
+            session.commit()
+            logging.info('@add_proxy success - {0} ips'.format(len(proxies)))
+        except Exception as e:
+            session.rollback()
+            logging.exception('@add_proxy ERROR: {0}'.format(e))
+        finally:
+            session.close()
         logging.info('@add_proxy finish.')
 
     @classmethod
-    def get_proxy_pool(cls):
+    def get_proxy_pool(cls, limit=50):
         session = DBSession()
         query = session.query(Proxy.ip) \
             .filter(Proxy.is_valid == 1, Proxy.cate == 'HTTP') \
             .order_by(Proxy.update_time.desc()) \
-            .limit(50)
+            .limit(limit)
         session.commit()
         session.close()
         proxy_pool = [x[0] for x in query]
@@ -156,16 +293,134 @@ class ProxyPool:
         logging.info("@enable ip: {}".format(ip))
 
     @classmethod
-    def batch_check(cls, limit=100, is_valid=1):
+    def batch_check(cls, limit=100, is_valid=1, parallelism=50, deadline=60):
         session = DBSession()
-        query = session.query(Proxy.ip) \
-            .filter(Proxy.is_valid == is_valid) \
-            .limit(limit)
-        for q in query:
-            if cls.is_valid_proxy(q[0]):
-                cls.enable(q[0])
+        ips = [x[0] for x in session.query(Proxy.ip).filter(Proxy.is_valid == is_valid).limit(limit)]
+        session.close()
+        cls.apply_results(cls.validate_many(ips, parallelism=parallelism, deadline=deadline))
+
+
+class ScoredProxyPool:
+    """
+    进程内代理池
+
+    从proxy_ip表加载一次，后台线程定期刷新；不再每次请求前验证代理，
+    而是根据真实爬取结果(report)维护每个代理的成功率、响应时间和最近失败时间，按得分加权随机选取。
+    连续失败max_failures次的代理移出代理池，失效/有效状态批量写回proxy_ip表。
+    """
+
+    def __init__(self, pool_size=200, refresh_interval=300, max_failures=3, flush_every=50):
+        self.pool_size = pool_size
+        self.refresh_interval = refresh_interval
+        self.max_failures = max_failures
+        self.flush_every = flush_every
+
+        self._proxies = {}
+        self._expired = set()
+        self._succeeded = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """ 加载代理池并启动后台刷新线程 """
+        with self._lock:
+            if self._thread:
+                return self
+            self._thread = threading.Thread(target=self._run, name='proxy-pool', daemon=True)
+        self.refresh()
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.flush()
+                self.refresh()
+            except Exception as e:
+                logging.exception('@proxy_pool refresh ERROR: {}'.format(e))
+
+    def refresh(self):
+        """ 从数据库重新加载，保留已有代理的统计数据 """
+        ips = ProxyPool.get_proxy_pool(limit=self.pool_size)
+        with self._lock:
+            self._proxies = {ip: self._proxies.get(ip) or {
+                'success': 0, 'failure': 0, 'continuous_failure': 0, 'latency': 1.0, 'last_failure': None,
+            } for ip in ips if ip not in self._expired}
+        logging.info('@proxy_pool refresh: {} proxies'.format(len(self._proxies)))
+
+    @staticmethod
+    def score(stats):
+        """ 平滑成功率 / 平均响应时间 """
+        success_rate = (stats['success'] + 1) / (stats['success'] + stats['failure'] + 2)
+        return success_rate / max(stats['latency'], 0.1)
+
+    def get(self):
+        """ 按得分加权随机选取一个代理 """
+        if not self._thread:
+            self.start()
+        with self._lock:
+            if not self._proxies:
+                return
+            ips = list(self._proxies)
+            weights = [self.score(self._proxies[ip]) for ip in ips]
+        return random.choices(ips, weights=weights)[0]
+
+    def report(self, ip, ok, latency=None):
+        """ 反馈一次真实请求的结果 """
+        flush = False
+        with self._lock:
+            stats = self._proxies.get(ip)
+            if stats is None:
+                return
+            if ok:
+                stats['success'] += 1
+                stats['continuous_failure'] = 0
+                if latency is not None:
+                    stats['latency'] = 0.8 * stats['latency'] + 0.2 * latency
+                self._succeeded.add(ip)
             else:
-                cls.expire(q[0])
+                stats['failure'] += 1
+                stats['continuous_failure'] += 1
+                stats['last_failure'] = datetime.datetime.now()
+                if stats['continuous_failure'] >= self.max_failures:
+                    del self._proxies[ip]
+                    self._succeeded.discard(ip)
+                    self._expired.add(ip)
+                    logging.info('@proxy_pool expire: {}'.format(ip))
+            flush = len(self._expired) + len(self._succeeded) >= self.flush_every
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """ 批量写回：失效代理置is_valid=0，有效代理刷新update_time """
+        with self._lock:
+            expired, self._expired = self._expired, set()
+            succeeded, self._succeeded = self._succeeded, set()
+        if not expired and not succeeded:
+            return
+
+        session = DBSession()
+        try:
+            if expired:
+                session.query(Proxy).filter(Proxy.ip.in_(expired)) \
+                    .update({'is_valid': 0}, synchronize_session=False)
+            if succeeded:
+                session.query(Proxy).filter(Proxy.ip.in_(succeeded)) \
+                    .update({'update_time': datetime.datetime.now()}, synchronize_session=False)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            logging.exception('@proxy_pool flush ERROR: {}'.format(e))
+        finally:
+            session.close()
+
+    def stats(self):
+        with self._lock:
+            return {ip: dict(x, score=round(self.score(x), 3)) for ip, x in self._proxies.items()}
+
+
+proxy_pool = ScoredProxyPool()
 
 
 if __name__ == '__main__':
@@ -182,7 +437,7 @@ if __name__ == '__main__':
     # proxies = [{'ip': x['ip:port'], 'cate': 'HTTP', 'source': 'manual'} for x in ips]
     # p_pool.add_proxy(proxy_list=proxies)
 
-    # p_pool.batch_check(limit=100, is_valid=0)
+    # p_pool.batch_check(limit=1000, is_valid=0, parallelism=100, deadline=60)
 
     # p_pool.expire('101.37.118.54:8888')
     # p_pool.enable('101.37.118.54:8888')
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+分批流式读取：服务端游标逐批读取sale_info/community_info/transaction_info，过滤条件下推到SQL，
+每批返回按字段类型转换后的DataFrame或numpy数组，内存占用只与batch_size有关，与累计的爬取天数无关
+
+for df in iter_frames('sale_info', start=datetime.date(2020, 7, 1), districts=['海淀']):
+    ...
+"""
+import datetime
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import DateTime, Float, Integer, Numeric, select
+
+from model import SaleInfo, CommunityInfo, TransactionInfo, get_engine
+
+TABLES = {
+    'sale_info': SaleInfo,
+    'community_info': CommunityInfo,
+    'transaction_info': TransactionInfo,
+}
+
+# 日期范围过滤的字段：在售/小区按爬取时间，成交按成交日期(字符串yyyy-mm-dd)
+DATE_COLUMNS = {
+    'sale_info': 'create_time',
+    'community_info': 'create_time',
+    'transaction_info': 'deal_date',
+}
+
+
+def column_dtype(column):
+    if isinstance(column.type, Integer):
+        # 可空整数，保证各批次dtype一致
+        return 'Int64'
+    if isinstance(column.type, (Float, Numeric)):
+        return 'float64'
+    if isinstance(column.type, DateTime):
+        return 'datetime64[ns]'
+    return 'object'
+
+
+def build_query(name, columns=None, start=None, end=None, districts=None, biz_circles=None):
+    """
+    :param columns: 读取的字段，默认全部
+    :param start: 起始日期(含)
+    :param end: 截止日期(不含)
+    :param districts: 区县
+    :param biz_circles: 商圈
+    成交表没有区县/商圈字段，通过小区表子查询过滤
+    """
+    table = TABLES[name].__table__
+    selected = [table.c[x] for x in columns] if columns else list(table.columns)
+    query = select(selected)
+
+    date_column = table.c[DATE_COLUMNS[name]]
+    if isinstance(date_column.type, DateTime):
+        to_value = lambda x: datetime.datetime.combine(x, datetime.time())
+    else:
+        to_value = lambda x: x.isoformat()
+    if start:
+        query = query.where(date_column >= to_value(start))
+    if end:
+        query = query.where(date_column < to_value(end))
+
+    if name == 'transaction_info' and (districts or biz_circles):
+        community = CommunityInfo.__table__
+        communities = select([community.c.community])
+        if districts:
+            communities = communities.where(community.c.district.in_(districts))
+        if biz_circles:
+            communities = communities.where(community.c.biz_circle.in_(biz_circles))
+        query = query.where(table.c.community.in_(communities))
+    else:
+        if districts:
+            query = query.where(table.c.district.in_(districts))
+        if biz_circles:
+            query = query.where(table.c.biz_circle.in_(biz_circles))
+    return query.order_by(*table.primary_key.columns)
+
+
+def iter_rows(name, batch_size=10000, **filters):
+    """ 服务端游标逐批读取，每批为batch_size行的列表 """
+    query = build_query(name, **filters)
+    with get_engine().connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(query)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+
+
+def iter_frames(name, batch_size=10000, **filters):
+    """ 逐批返回DataFrame，各字段按模型类型转换 """
+    table = TABLES[name].__table__
+    dtypes = {x: column_dtype(table.c[x]) for x in filters.get('columns') or table.columns.keys()}
+    for rows in iter_rows(name, batch_size, **filters):
+        df = pd.DataFrame.from_records(rows, columns=list(dtypes))
+        for column, dtype in dtypes.items():
+            if dtype == 'float64':
+                df[column] = pd.to_numeric(df[column], errors='coerce')
+            elif dtype != 'object':
+                df[column] = df[column].astype(dtype)
+        yield df
+
+
+def iter_arrays(name, batch_size=10000, **filters):
+    """ 逐批返回 {字段: numpy数组}，整数字段的空值转为nan """
+    for df in iter_frames(name, batch_size, **filters):
+        arrays = {}
+        for column in df.columns:
+            if str(df[column].dtype) == 'Int64':
+                arrays[column] = df[column].to_numpy(dtype='float64', na_value=np.nan)
+            else:
+                arrays[column] = df[column].to_numpy()
+        yield arrays
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+每日汇总：爬取后按 日期 × 区县/商圈/小区 预先聚合，写入sale_rollup/transaction_rollup，看板直接读取汇总表
+
+python rollup.py sale --date 2020-07-26
+python rollup.py transaction --since 2020-07-01
+"""
+import argparse
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from model import SaleRollup, TransactionRollup, get_engine
+from settings import logging
+
+# 汇总层级 -> 分组字段
+LEVELS = [
+    ('district', ['district']),
+    ('biz_circle', ['district', 'biz_circle']),
+    ('community', ['district', 'community']),
+]
+
+# 挂牌天数在此之内的视为新挂牌
+RECENT_DAYS = 30
+
+
+def aggregate(df, date_column, metrics):
+    """
+    按LEVELS逐层分组聚合(向量化)
+    :param metrics: {输出字段: (输入字段, 聚合函数)}
+    """
+    frames = []
+    for level, keys in LEVELS:
+        agg = df.groupby([date_column] + keys).agg(**metrics).reset_index()
+        agg['level'] = level
+        agg['name'] = agg[keys[-1]]
+        frames.append(agg[[date_column, 'level', 'district', 'name'] + list(metrics)])
+    return pd.concat(frames, ignore_index=True).rename(columns={date_column: 'date'})
+
+
+def save_rollup(model, df, dates):
+    """ 覆盖写入dates对应的汇总 """
+    table = model.__table__
+    rows = df.replace({np.nan: None}).to_dict('records')
+    with get_engine().begin() as conn:
+        conn.execute(table.delete().where(table.c.date.in_(dates)))
+        for i in range(0, len(rows), 1000):
+            conn.execute(table.insert(), rows[i:i + 1000])
+    logging.info('@rollup: {0} - {1} rows for {2}'.format(table.name, len(rows), ', '.join(map(str, dates))))
+    return len(rows)
+
+
+def rollup_sale(date, source='sale_info'):
+    """ 汇总某一爬取日期的在售房源，source: sale_info 或 sale_snapshot(增量存储的兼容视图) """
+    next_date = date + datetime.timedelta(days=1)
+    sql = f"""
+        SELECT id, house_id, district, biz_circle, community, put_date, total_price, unit_price, area
+        FROM {source}
+        WHERE create_time >= '{date.isoformat()}' AND create_time < '{next_date.isoformat()}'
+    """
+    df = pd.read_sql_query(sql, get_engine())
+    if df.empty:
+        return 0
+
+    # 同一天多次爬取的取最后一次
+    df = df.sort_values('id').drop_duplicates('house_id', keep='last')
+    df['date'] = date
+    put_days = (pd.Timestamp(date) - pd.to_datetime(df.put_date, errors='coerce')).dt.days
+    recent = put_days <= RECENT_DAYS
+    for column in ['total_price', 'unit_price', 'area']:
+        df[column] = pd.to_numeric(df[column], errors='coerce')
+        df['recent_' + column] = df[column].where(recent)
+    df['recent'] = recent.astype(int)
+
+    result = aggregate(df, 'date', {
+        'listing_count': ('house_id', 'size'),
+        'total_price_median': ('total_price', 'median'),
+        'unit_price_median': ('unit_price', 'median'),
+        'area_median': ('area', 'median'),
+        'recent_count': ('recent', 'sum'),
+        'recent_total_price_median': ('recent_total_price', 'median'),
+        'recent_unit_price_median': ('recent_unit_price', 'median'),
+        'recent_area_median': ('recent_area', 'median'),
+    })
+    return save_rollup(SaleRollup, result, [date])
+
+
+def rollup_transaction(since):
+    """ 重新汇总since之后的成交(成交记录会延迟上架，增量时since取上次汇总日期之前一段时间) """
+    sql = f"""
+        SELECT t.id, t.deal_date, c.district, c.biz_circle, t.community,
+          t.deal_price, t.put_price, t.unit_price, t.area, t.deal_period
+        FROM transaction_info t
+        INNER JOIN community_info c ON c.community = t.community
+        WHERE t.deal_date >= '{since.isoformat()}'
+    """
+    df = pd.read_sql_query(sql, get_engine())
+    df['date'] = pd.to_datetime(df.deal_date, errors='coerce').dt.date
+    df = df.dropna(subset=['date']).drop_duplicates('id', keep='last')
+    if df.empty:
+        return 0
+
+    for column in ['deal_price', 'put_price', 'unit_price', 'area', 'deal_period']:
+        df[column] = pd.to_numeric(df[column], errors='coerce')
+    df['price_diff'] = df.put_price - df.deal_price
+
+    result = aggregate(df, 'date', {
+        'deal_count': ('id', 'size'),
+        'deal_price_median': ('deal_price', 'median'),
+        'unit_price_median': ('unit_price', 'median'),
+        'area_median': ('area', 'median'),
+        'deal_period_median': ('deal_period', 'median'),
+        'price_diff_median': ('price_diff', 'median'),
+    })
+    return save_rollup(TransactionRollup, result, sorted(df.date.unique()))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('module', choices=['sale', 'transaction'])
+    arg_parser.add_argument('--date', help='sale: 爬取日期，默认今天')
+    arg_parser.add_argument('--since', help='transaction: 起始成交日期，默认60天前')
+    arg_parser.add_argument('--source', choices=['sale_info', 'sale_snapshot'], default='sale_info')
+    args = arg_parser.parse_args()
+
+    parse_date = datetime.datetime.strptime
+    if args.module == 'sale':
+        date = parse_date(args.date, '%Y-%m-%d').date() if args.date else datetime.date.today()
+        rollup_sale(date, args.source)
+    else:
+        since = parse_date(args.since, '%Y-%m-%d').date() if args.since \
+            else datetime.date.today() - datetime.timedelta(days=60)
+        rollup_transaction(since)
+
+
+if __name__ == '__main__':
+    main()
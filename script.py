@@ -1,6 +1,10 @@
+import datetime
+
 from settings import logging
 from model import init_db, drop_db
 from spider import LianJiaSpider
+from frontier import Frontier
+from rollup import rollup_sale, rollup_transaction
 
 
 CITY = 'bj'  # only one
@@ -31,16 +35,28 @@ def run_spider():
     # 2. 按照商圈爬取（推荐）
     biz_circles = spider.query_biz_circle(districts=DISTRICTS_CN)
     spider.set_request_params(max_workers=3, delay=0.5)  # 限速
+    # spider.set_detail_cache(ttl_days=30)  # 详情页缓存：命中时不再请求详情页(follow为空)
+    # spider.set_metrics(report='metrics.json', port=9108)  # 各阶段耗时/状态码/入库条数，JSON报告或Prometheus
     spider.crawl_search_pool(module='sale_info', collection=biz_circles, coll_start=1)
     # 3. 按照社区爬取
     # communities = spider.query_community(biz_circle=biz_circles)
     # spider.crawl_search_pool(module='sale_info', collection=communities)
+    # 4. 多机器分摊：各机器运行相同的seed和crawl_frontier
+    # frontier = Frontier()
+    # frontier.seed('sale_info', 'search', biz_circles)
+    # spider.crawl_frontier(frontier)
 
     # 爬取历史成交
     spider.set_request_params(max_workers=1, delay=3)  # 限速
     spider.crawl_search_pool(module='transaction_info', collection=biz_circles, coll_start=1)
+    # 增量更新：爬到已入库的成交为止
+    # spider.crawl_search_pool(module='transaction_info', collection=biz_circles, incremental=True)
     # spider.crawl_search_pool(module='transaction_info', collection=communities)
 
+    # 每日汇总
+    rollup_sale(datetime.date.today())
+    rollup_transaction(datetime.date.today() - datetime.timedelta(days=60))
+
     logging.info("Spider finished ...")
 
 
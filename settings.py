@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import logging
+import os
 
 DB_NAME = 'house'  # test
 DB_USER = 'test'
@@ -7,6 +8,12 @@ DB_PASSWORD = '123456'
 DB_HOST = '127.0.0.1'
 DB_PORT = 3306
 
+# 数据库连接URL，可用环境变量覆盖，如 sqlite:///house.db、duckdb:///house.duckdb(需安装duckdb_engine)
+DB_URL = os.environ.get(
+    'DB_URL', f'mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}?charset=utf8')
+PROXY_DB_URL = os.environ.get(
+    'PROXY_DB_URL', f'mysql+pymysql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/proxy?charset=utf8')
+
 logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s',
     level=logging.INFO)
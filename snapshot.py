@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import datetime
+import math
+import threading
+
+from sqlalchemy import func
+
+from model import SaleListing, SaleObservation, SaleCrawlDate, DBSession, upsert
+from settings import logging
+
+# 每次爬取可能变化的字段记录在sale_observation，其余字段记录在sale_listing
+OBSERVED_FIELDS = ['total_price', 'unit_price', 'follow']
+LISTING_FIELDS = [x.name for x in SaleListing.__table__.columns if x.name not in ('first_seen', 'last_seen')]
+
+_lock = threading.Lock()
+
+
+def to_int(value):
+    """ 转为Integer字段入库后的值(小数四舍五入，与mysql一致)，解析器返回的follow为字符串 """
+    try:
+        return int(math.floor(float(value) + 0.5))
+    except (TypeError, ValueError):
+        return None
+
+
+def save_sale_delta(records, crawl_date=None):
+    """
+    在售房源增量存储
+    1）sale_listing: 每套房源一行，upsert最新的属性和最近爬取日期；
+    2）sale_observation: 价格/关注人数(转为整数后)与上一条观测相同，且上一条观测截止于该区县上次爬取日期(连续在售)时，
+       只延长valid_to，否则新增一行；
+    3）sale_crawl_date: 记录各区县的爬取日期。
+    详情页缓存命中时follow为空，视为未变化。
+    """
+    crawl_date = crawl_date or datetime.date.today()
+    records = list({x['house_id']: x for x in records}.values())
+    if not records:
+        return
+
+    districts = list({x['district'] for x in records})
+    house_ids = [x['house_id'] for x in records]
+    listings = [dict({x: record.get(x) for x in LISTING_FIELDS}, last_seen=crawl_date) for record in records]
+
+    with _lock:
+        upsert(SaleListing, listings)
+        upsert(SaleCrawlDate, [{'crawl_date': crawl_date, 'district': x} for x in districts])
+
+        session = DBSession()
+        try:
+            previous = dict(session.query(SaleCrawlDate.district, func.max(SaleCrawlDate.crawl_date))
+                            .filter(SaleCrawlDate.district.in_(districts), SaleCrawlDate.crawl_date < crawl_date)
+                            .group_by(SaleCrawlDate.district))
+            since = min(list(previous.values()) + [crawl_date])
+            last = {}
+            query = session.query(SaleObservation) \
+                .filter(SaleObservation.house_id.in_(house_ids), SaleObservation.valid_to >= since) \
+                .order_by(SaleObservation.valid_to)
+            for x in query:
+                last[x.house_id] = x
+
+            new, extended = [], []
+            for record in records:
+                observed = dict(house_id=record['house_id'], valid_from=crawl_date, valid_to=crawl_date)
+                values = {x: to_int(record.get(x)) for x in OBSERVED_FIELDS}
+                observation = last.get(record['house_id'])
+                if observation and values['follow'] is None:
+                    values['follow'] = observation.follow
+                changed = not observation or any(getattr(observation, x) != values[x] for x in OBSERVED_FIELDS)
+
+                if observation and observation.valid_to >= crawl_date:
+                    # 同一天重复爬取，以最新的为准
+                    if changed and observation.valid_from >= crawl_date:
+                        for x in OBSERVED_FIELDS:
+                            setattr(observation, x, values[x])
+                    elif changed:
+                        observation.valid_to = previous.get(record['district'], observation.valid_from)
+                        new.append(dict(values, **observed))
+                elif not changed and observation.valid_to >= previous.get(record['district'], crawl_date):
+                    extended.append(observation.id)
+                else:
+                    new.append(dict(values, **observed))
+
+            for i in range(0, len(extended), 500):
+                session.query(SaleObservation) \
+                    .filter(SaleObservation.id.in_(extended[i:i + 500])) \
+                    .update({'valid_to': crawl_date}, synchronize_session=False)
+            session.bulk_insert_mappings(SaleObservation, new)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    logging.info('@save_sale_delta: {0} listings, {1} new observations, {2} extended'.format(
+        len(listings), len(new), len(extended)))
@@ -1,75 +1,70 @@
 # -*- coding: utf-8 -*-
+import datetime
 import json
 import re
 import time
 import functools
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+from contextlib import contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from warnings import filterwarnings
 
+import lxml.html
 from bs4 import BeautifulSoup
-
-from model import SaleInfo, CommunityInfo, TransactionInfo, DBSession
+from lxml import etree
+
+from cache import DetailCache
+from hints import CrawlHints
+from metrics import metrics
+from model import SaleInfo, CommunityInfo, TransactionInfo, DBSession, BatchWriter, bulk_insert, upsert
+from pipeline import DetailPipeline
+from snapshot import save_sale_delta
 from settings import logging
-from utils import request_data
+from utils import request_data, session_manager, rate_limiter
 
 filterwarnings("ignore")
 
-
-class LianJiaSpider:
-    """
-    链家二手房爬虫
-
-    分为三个部分：
-    1）在售房源：sale_info, 全量更新；
-    2）小区信息：community_info，增量更新；
-    3) 历史成交：transaction_info，增量更新；
-
-    支持 - 城市选择：1个
-    支持 - 通过指定区县爬取（粗粒度）；
-    支持 - 通过搜索商圈或小区爬取（细粒度）；
-    """
-
-    def __init__(self, city, districts):
-        self.base_url = f"http://{city}.lianjia.com/"
-        self.city = city
-        self.districts = districts
-
-        self.bs4_parser = "lxml"
-        self.max_workers = 3
-        self.request_fn = functools.partial(
-            request_data,
-            retry=2,
-            timeout=10,
-            auto_proxy=False,
-            delay=0.5
-        )
-
-    def set_request_params(self, max_workers, delay, retry=2, auto_proxy=False):
-        """ 设置request参数 """
-        self.max_workers = max_workers
-        self.request_fn = functools.partial(
-            request_data,
-            retry=retry,
-            timeout=10,
-            auto_proxy=auto_proxy,
-            delay=delay
-        )
-
-    def get_total_pages(self, url):
-        """ 总页码数 """
-        total_pages = 0
-        content = self.request_fn(url)
-        if not content:
-            return total_pages
-
-        soup = BeautifulSoup(content, self.bs4_parser)
+# 在售房源详情页 基本属性/交易属性 -> sale_info字段
+SALE_BASE_KEY_MAP = {
+    '上次交易': 'last_date',
+    '交易权属': 'trans_auth',
+    '产权所属': 'property_auth',
+    '供暖方式': 'heating',
+    '套内面积': 'inside_area',
+    '建筑结构': 'material',
+    '户型结构': 'duplex',
+    '房屋年限': 'use_year',
+    '房屋户型': 'layout',
+    '房屋用途': 'usage',
+    '房本备件': 'certificate',
+    '抵押信息': 'mortgage',
+    '挂牌时间': 'put_date',
+    '梯户比例': 'ladder_ratio',
+    '配备电梯': 'has_ladder'
+}
+
+
+class Bs4Parser:
+    """ 解析器: BeautifulSoup """
+
+    def __init__(self, features="lxml"):
+        self.features = features
+
+    def total_pages(self, content):
+        """ 解析列表页总页码数 """
+        soup = BeautifulSoup(content, self.features)
         page_data = soup.find('div', class_='page-box house-lst-page-box').get('page-data')
-        total_pages = json.loads(page_data).get('totalPage')
+        return json.loads(page_data).get('totalPage')
 
-        return total_pages
+    def list_items(self, module, content):
+        """ 列表页条目 """
+        soup = BeautifulSoup(content, self.features)
+        ul_class = 'sellListContent' if module == 'sale_info' else 'listContent'
+        return [item_tag for ul_tag in soup.find_all("ul", class_=ul_class)
+                for item_tag in ul_tag.find_all("li")]
 
-    def parse_sale_content(self, item_tag):
-        """ 在售房源列表 单条解析(含详情页) """
+    def sale_item(self, item_tag):
+        """ 在售房源列表 单条解析(仅导航页) """
         info_dict = dict()
 
         # 导航页
@@ -137,8 +132,12 @@ class LianJiaSpider:
             'subway_tag': subway_tag,
         })
 
-        # 详情页
-        details = BeautifulSoup(self.request_fn(link), self.bs4_parser)
+        return info_dict
+
+    def sale_details(self, content):
+        """ 在售房源详情页解析 """
+        info_dict = dict()
+        details = BeautifulSoup(content, self.features)
 
         # 1. 图片和位置
         image_info = details.find('ul', class_='smallpic')
@@ -168,24 +167,7 @@ class LianJiaSpider:
         transaction_items = {x.contents[1].text: x.contents[3].text
                              for x in transaction_info.find_all('li')}
         base_items.update(transaction_items)
-        base_key_map = {
-            '上次交易': 'last_date',
-            '交易权属': 'trans_auth',
-            '产权所属': 'property_auth',
-            '供暖方式': 'heating',
-            '套内面积': 'inside_area',
-            '建筑结构': 'material',
-            '户型结构': 'duplex',
-            '房屋年限': 'use_year',
-            '房屋户型': 'layout',
-            '房屋用途': 'usage',
-            '房本备件': 'certificate',
-            '抵押信息': 'mortgage',
-            '挂牌时间': 'put_date',
-            '梯户比例': 'ladder_ratio',
-            '配备电梯': 'has_ladder'
-        }
-        base_result = {v: base_items.get(k) for k, v in base_key_map.items()}
+        base_result = {v: base_items.get(k) for k, v in SALE_BASE_KEY_MAP.items()}
         search = re.search(r'\d+\.?\d+', base_result['inside_area'])
         base_result['inside_area'] = float(search.group()) if search else 0  # 可能暂无数据
         if base_result['mortgage']:
@@ -194,8 +176,8 @@ class LianJiaSpider:
 
         return info_dict
 
-    def parse_community_content(self, item_tag):
-        """ 小区列表 单条解析(含详情页) """
+    def community_item(self, item_tag):
+        """ 小区列表 单条解析(仅导航页) """
         info_dict = dict()
 
         # 导航信息
@@ -215,8 +197,12 @@ class LianJiaSpider:
             'link': link,
         })
 
-        # 详情页
-        details = BeautifulSoup(self.request_fn(link), self.bs4_parser)
+        return info_dict
+
+    def community_details(self, content):
+        """ 小区详情页解析 """
+        info_dict = dict()
+        details = BeautifulSoup(content, self.features)
 
         header_info = details.find('div', class_='xiaoquDetailHeader')
         if header_info:
@@ -262,8 +248,7 @@ class LianJiaSpider:
             })
         return info_dict
 
-    @classmethod
-    def parse_transaction_content(cls, item_tag):
+    def transaction_item(self, item_tag):
         """ 成交列表 单条解析 """
 
         info_dict = dict()
@@ -353,193 +338,1038 @@ class LianJiaSpider:
 
         return info_dict
 
-    def crawl_sale_by_district(self, args):
-        """ 根据区县爬取一页在售房源 """
-        district, page = args
-        url_page = self.base_url + f"ershoufang/{district}/pg{page}/"
-        content = self.request_fn(url_page)
-        soup = BeautifulSoup(content, self.bs4_parser)
-        logging.debug('@crawl_sale_by_district: {0} - page - {1}: {2}'.format(district, page, url_page))
 
-        session = DBSession()
-        for ul_tag in soup.find_all("ul", class_="sellListContent"):
-            for item_tag in ul_tag.find_all("li"):
-                try:
-                    info_dict = self.parse_sale_content(item_tag)
-                    logging.debug('@crawl_sale_by_district: {0} - page - {1}: {2}'.format(district, page, info_dict))
-                    sale_info = SaleInfo(**info_dict)
-                    if sale_info.house_id and sale_info.community_id and sale_info.district:
-                        session.add(sale_info)
-                except Exception as e:
-                    session.rollback()
-                    logging.exception('@crawl_sale_by_district: {0} - page - {1}: {2}'.format(district, page, e))
-                    time.sleep(3)
+def _class_xpath(tag, class_name, extra=''):
+    """ 与bs4 class_匹配一致：单个类名匹配class属性中的任一类名，含空格时匹配完整的class属性字符串 """
+    if ' ' in class_name:
+        condition = '[@class="{}"]'.format(class_name)
+    else:
+        condition = "[contains(concat(' ', normalize-space(@class), ' '), ' {} ')]".format(class_name)
+    return etree.XPath('.//{0}{1}{2}'.format(tag, condition, extra))
+
+
+def _first(xpath, element):
+    result = xpath(element)
+    return result[0] if result else None
+
+
+def _text(node):
+    """ 等价于bs4 .text """
+    return node if isinstance(node, str) else node.text_content()
+
+
+def _contents(element):
+    """ 等价于bs4 .contents：文本节点和子元素按顺序排列 """
+    contents = [element.text] if element.text else []
+    for child in element:
+        contents.append(child)
+        if child.tail:
+            contents.append(child.tail)
+    return contents
+
+
+class LxmlParser:
+    """ 解析器: lxml.html + 预编译XPath，输出与Bs4Parser一致 """
+
+    PAGE_BOX = _class_xpath('div', 'page-box house-lst-page-box')
+    SALE_LIST = _class_xpath('ul', 'sellListContent')
+    LIST = _class_xpath('ul', 'listContent')
+    LI = etree.XPath('.//li')
+    A = etree.XPath('.//a')
+    SPAN = etree.XPath('.//span')
+
+    TITLE = _class_xpath('div', 'title')
+    POSITION = _class_xpath('div', 'positionInfo')
+    REGION = etree.XPath('.//a[@data-el="region"]')
+    HOUSE_INFO = _class_xpath('div', 'houseInfo')
+    TOTAL_PRICE = _class_xpath('div', 'totalPrice')
+    UNIT_PRICE = _class_xpath('div', 'unitPrice')
+    TAX_FREE = _class_xpath('span', 'taxfree')
+    FIVE = _class_xpath('span', 'five')
+    SUBWAY = _class_xpath('span', 'subway')
+
+    SMALL_PIC = _class_xpath('ul', 'smallpic')
+    LAYOUT_IMAGE = etree.XPath('.//li[@data-desc="户型图"]')
+    AREA_NAME = _class_xpath('div', 'areaName')
+    INFO = _class_xpath('span', 'info')
+    FOLLOW = _class_xpath('span', 'count', '[@id="favCount"]')
+    INTRO = _class_xpath('div', 'introContent')
+    BASE = _class_xpath('div', 'base')
+    TRANSACTION = _class_xpath('div', 'transaction')
+
+    TAG_LIST = _class_xpath('div', 'tagList')
+    DISTRICT = _class_xpath('a', 'district')
+    BIZ_CIRCLE = _class_xpath('a', 'bizcircle')
+    XIAOQU_HEADER = _class_xpath('div', 'xiaoquDetailHeader')
+    DETAIL_DESC = _class_xpath('div', 'detailDesc')
+    FOLLOW_NUMBER = etree.XPath('.//span[@data-role="followNumber"]')
+    XIAOQU_DESCRIBE = _class_xpath('div', 'xiaoquDescribe fr')
+    XIAOQU_INFO = _class_xpath('div', 'xiaoquInfo')
+    XIAOQU_INFO_ITEM = _class_xpath('div', 'xiaoquInfoItem')
+    SHOW_MAP = _class_xpath('span', 'actshowMap')
+
+    DEAL_DATE = _class_xpath('div', 'dealDate')
+    DEAL_HOUSE = _class_xpath('span', 'dealHouseTxt')
+    DEAL_CYCLE = _class_xpath('span', 'dealCycleTxt')
+
+    def total_pages(self, content):
+        """ 解析列表页总页码数 """
+        page_data = _first(self.PAGE_BOX, lxml.html.fromstring(content)).get('page-data')
+        return json.loads(page_data).get('totalPage')
+
+    def list_items(self, module, content):
+        """ 列表页条目 """
+        ul_xpath = self.SALE_LIST if module == 'sale_info' else self.LIST
+        return [item for ul in ul_xpath(lxml.html.fromstring(content)) for item in self.LI(ul)]
+
+    def sale_item(self, item_tag):
+        """ 在售房源列表 单条解析(仅导航页) """
+        info_dict = dict()
 
-        session.commit()
-        session.close()
-        logging.info('@crawl_sale_by_page: {0} - page - {1} complete.'.format(district, page))
+        # 1. 标题
+        title_tag = _first(self.TITLE, item_tag)
+        title_a = _first(self.A, title_tag)
+        recommend_tag = _first(self.SPAN, title_tag)
+        info_dict.update({
+            'house_id': title_a.get('data-housecode'),
+            'title': title_a.text_content(),
+            'link': title_a.get('href'),
+            'recommend_tag': recommend_tag.text_content() if recommend_tag is not None else None
+        })
 
-    def crawl_community_by_district(self, args):
-        """ 根据区县爬取一页小区信息 """
-        district, page = args
-        url_page = self.base_url + f"xiaoqu/{district}/pg{page}/"
-        content = self.request_fn(url_page)
-        soup = BeautifulSoup(content, self.bs4_parser)
-        logging.debug('@crawl_community_by_district: {0} - page - {1}: {2}'.format(district, page, url_page))
+        # 2. 位置
+        position_tag = _first(self.POSITION, item_tag)
+        community, biz_circle = position_tag.text_content().split('-')
+        community_id = _first(self.REGION, position_tag).get('href').split('/')[-2]
+        info_dict.update({
+            'biz_circle': biz_circle.strip(),
+            'community': community.strip(),
+            'community_id': community_id,
+        })
 
-        session = DBSession()
-        for ul_tag in soup.find_all("ul", class_="listContent"):
-            for item_tag in ul_tag.find_all("li"):
-                try:
-                    info_dict = self.parse_community_content(item_tag)
-                    query = session.query(CommunityInfo).filter(CommunityInfo.id == info_dict['id'])
-                    if query.first():
-                        query.update(info_dict)
-                    else:
-                        session.add(CommunityInfo(**info_dict))
-                    session.commit()
-                    logging.debug('@crawl_community_by_district: {0} - page - {1}: {2}'.format(district, page, info_dict))
-                except Exception as e:
-                    session.rollback()
-                    logging.exception('@crawl_community_by_district: {0} - page - {1}: {2}'.format(district, page, e))
-                    time.sleep(3)
+        # 3. 房屋参数
+        house_info = _first(self.HOUSE_INFO, item_tag).text_content().replace(' ', '').split('|')
+        search = re.search(r'\d+', house_info[4])
+        total_floor = search.group() if search else None
+        search = re.search(r'\d{4}', house_info[5])
+        build_year = search.group() if search else house_info[5]
+        total_price = _first(self.SPAN, _first(self.TOTAL_PRICE, item_tag)).text_content()
+        unit_price = _first(self.UNIT_PRICE, item_tag).get('data-price')
+        info_dict.update({
+            'layout': house_info[0],
+            'area': float(house_info[1].strip('平米')),
+            'orient': house_info[2],
+            'decoration': house_info[3],
+            'floor_level': house_info[4].split('(')[0],
+            'total_floor': int(total_floor),
+            'build_year': build_year,
+            'structure': house_info[6] if len(house_info) > 6 else None,
+            'total_price': float(total_price),
+            'unit_price': int(unit_price)
+        })
 
-        session.close()
-        logging.info('@crawl_community_by_district: {0} - page - {1} complete.'.format(district, page))
+        # 4. 特色标签
+        tax_free_tag = _first(self.TAX_FREE, item_tag)
+        if tax_free_tag is None:
+            tax_free_tag = _first(self.FIVE, item_tag)
+        subway_tag = _first(self.SUBWAY, item_tag)
+        info_dict.update({
+            'tax_free_tag': tax_free_tag.text_content() if tax_free_tag is not None else None,
+            'subway_tag': subway_tag.text_content() if subway_tag is not None else None,
+        })
 
-    def crawl_district_pool(self, module, max_pages=100):
-        """ 依据地区批量爬取 """
+        return info_dict
+
+    def sale_details(self, content):
+        """ 在售房源详情页解析 """
+        info_dict = dict()
+        details = lxml.html.fromstring(content)
+
+        # 1. 图片和位置
+        image_info = _first(self.SMALL_PIC, details)
+        if image_info is not None:
+            top_image = _first(self.LI, image_info)
+            layout_image = _first(self.LAYOUT_IMAGE, image_info)
+            info_dict.update({
+                'top_image': top_image.get('data-src') if top_image is not None else None,
+                'layout_image': layout_image.get('data-src') if layout_image is not None else None,
+            })
+        area_info = _first(self.AREA_NAME, details)
+        if area_info is not None:
+            info_dict.update({'district': _first(self.INFO, area_info).text_content().split()[0]})
+        follow = _first(self.FOLLOW, details)
+        info_dict.update({'follow': follow.text_content() if follow is not None else None})
 
-        crawl_mapper = {
-            'sale_info': {
-                'url': 'ershoufang',
-                'func': self.crawl_sale_by_district
-            },
-            'community_info':  {
-                'url': 'xiaoqu',
-                'func': self.crawl_community_by_district
-            },
+        # 2. 主要信息
+        major_content = _first(self.INTRO, details)
+        base_items = {_text(x[0]): x[1] for x in map(_contents, self.LI(_first(self.BASE, major_content)))}
+        base_items.update({_text(x[1]): _text(x[3])
+                           for x in map(_contents, self.LI(_first(self.TRANSACTION, major_content)))})
+        base_result = {v: base_items.get(k) for k, v in SALE_BASE_KEY_MAP.items()}
+        search = re.search(r'\d+\.?\d+', base_result['inside_area'])
+        base_result['inside_area'] = float(search.group()) if search else 0
+        if base_result['mortgage']:
+            base_result['mortgage'] = base_result['mortgage'].strip('\n').strip()
+        info_dict.update(base_result)
+
+        return info_dict
+
+    def community_item(self, item_tag):
+        """ 小区列表 单条解析(仅导航页) """
+        community_tag = _first(self.TAG_LIST, item_tag).text_content()
+        position_info = _first(self.POSITION, item_tag)
+        return {
+            'id': item_tag.get('data-id'),
+            'community': _first(self.TITLE, item_tag).text_content().strip('\n'),
+            'tag': community_tag.strip('\n') if community_tag else None,
+            'district': _first(self.DISTRICT, position_info).text_content(),
+            'biz_circle': _first(self.BIZ_CIRCLE, position_info).text_content(),
+            'link': _first(self.A, item_tag).get('href'),
         }
-        url_prefix = crawl_mapper[module]['url']
-        crawl_function = crawl_mapper[module]['func']
-
-        for district in self.districts:
-            url = self.base_url + f"{url_prefix}/{district}/"
-            total_pages = self.get_total_pages(url)
-            total_pages = min(total_pages, max_pages)
-            logging.info("@crawl_{0}: total {1} pages found for {2}".format(
-                module, total_pages, district))
-
-            if not total_pages:
-                logging.exception("@crawl_{0}: no pages found for {1}".format(
-                    module, district))
-                continue
 
-            executor = ThreadPoolExecutor(max_workers=self.max_workers)
-            args = [(district, page + 1) for page in range(total_pages)]
-            all_task = [executor.submit(crawl_function, arg) for arg in args]
-            for future in as_completed(all_task):
-                future.result()
+    def community_details(self, content):
+        """ 小区详情页解析 """
+        info_dict = dict()
+        details = lxml.html.fromstring(content)
+
+        header_info = _first(self.XIAOQU_HEADER, details)
+        if header_info is not None:
+            address = _first(self.DETAIL_DESC, header_info)
+            follow = _first(self.FOLLOW_NUMBER, header_info)
+            if address is not None:
+                info_dict.update({"address": address.text_content()})
+            if follow is not None:
+                info_dict.update({"follow": follow.text_content()})
+
+        describe = _first(self.XIAOQU_DESCRIBE, details)
+        if describe is not None:
+            base_info = _first(self.XIAOQU_INFO, describe)
+            base_items = [_text(_contents(x)[1]) for x in self.XIAOQU_INFO_ITEM(base_info)]
+            search = re.search(r'\d+', base_items[0])
+            position = _first(self.SHOW_MAP, base_info)
+            if position is not None:
+                lng, lat = position.get('xiaoqu').split(',')
+                lng, lat = float(lng.strip('[')), float(lat.strip(']'))
+            else:
+                lng, lat = None, None
+            info_dict.update({
+                'year': search.group() if search else None,
+                'structure': base_items[1],
+                'property_fee': base_items[2],
+                'property_company': base_items[3],
+                'developer': base_items[4],
+                'num_building': int(re.search(r'\d+', base_items[5]).group()),
+                'num_household': int(re.search(r'\d+', base_items[6]).group()),
+                'lng': lng,
+                'lat': lat,
+            })
+        return info_dict
 
-            logging.info("@crawl_{0}: {1} - all {2} pages complete.".format(
-                module, district, total_pages))
-            time.sleep(1)
+    def transaction_item(self, item_tag):
+        """ 成交列表 单条解析 """
+        info_dict = dict()
 
-    def crawl_sale_by_search(self, args):
-        """ 根据商圈或社区爬取一页在售房源 """
-        search_key, page = args
-        url_page = self.base_url + f"ershoufang/pg{page}rs{search_key}/"
-        content = self.request_fn(url_page)
-        soup = BeautifulSoup(content, self.bs4_parser)
-        logging.debug('@crawl_sale_by_search: {0} - page - {1}: {2}'.format(search_key, page, url_page))
+        title = _first(self.TITLE, item_tag)
+        title_info = title.text_content().split(' ')
+        area = title_info[2] if len(title_info) > 2 else '0'
+        area = re.search(r'\d+', area)
+        link = _first(self.A, title).get('href')
+        house_id = link.split('/')[-1].split('.')[0]
+        info_dict.update({
+            'house_id': house_id,
+            'community': title_info[0],
+            'layout': title_info[1] if len(title_info) > 1 else None,
+            'area': area.group() if area else None,
+            'link': link,
+        })
 
-        session = DBSession()
-        for ul_tag in soup.find_all("ul", class_="sellListContent"):
-            for item_tag in ul_tag.find_all("li"):
-                try:
-                    info_dict = self.parse_sale_content(item_tag)
-                    logging.debug('@crawl_sale_by_search: {0} - page - {1}: {2}'.format(search_key, page, info_dict))
-                    sale_info = SaleInfo(**info_dict)
-                    if not sale_info.house_id or not sale_info.community_id or not sale_info.district:
-                        continue
-                    session.add(sale_info)
-                except Exception as e:
-                    session.rollback()
-                    logging.exception('@crawl_sale_by_search: {0} - page - {1}: {2}'.format(search_key, page, e))
-                    time.sleep(3)
-        session.commit()
-        session.close()
-        logging.info('@crawl_sale_by_search: {0} - page - {1} complete.'.format(search_key, page))
+        house_info = _first(self.HOUSE_INFO, item_tag).text_content().split('|')
+        orient = house_info[0] if house_info else ''
+        decoration = house_info[1] if len(house_info) > 1 else ''
+        info_dict.update({
+            'orient': orient.replace(' ', ''),
+            'decoration': decoration.strip()
+        })
 
-    def crawl_transaction_by_search(self, args):
-        """ 依据商圈或小区 爬取一页历史成交房源 """
-        search_key, page = args
-        url_page = self.base_url + f"chengjiao/pg{page}rs{search_key}/"
-        content = self.request_fn(url_page)
-        soup = BeautifulSoup(content, self.bs4_parser)
-        logging.debug('@crawl_transaction_by_search: {0} - page - {1}: {2}'.format(search_key, page, url_page))
+        deal_date = _first(self.DEAL_DATE, item_tag).text_content().replace('.', '-')[:10]
+        total_price = _range_price(_first(self.SPAN, _first(self.TOTAL_PRICE, item_tag)))
+        unit_price = _range_price(_first(self.SPAN, _first(self.UNIT_PRICE, item_tag)))
+        info_dict.update({
+            'id': house_id + '_' + deal_date[:7],
+            'deal_date': deal_date,
+            'deal_price': total_price,
+            'unit_price': unit_price
+        })
 
-        session = DBSession()
-        for ul_tag in soup.find_all("ul", class_="listContent"):
-            for item_tag in ul_tag.find_all("li"):
+        floor_info, building_info = _first(self.POSITION, item_tag).text_content().split(' ')
+        search = re.search(r'\d+', floor_info)
+        if '年建' in building_info:
+            building_info = building_info.split('年建')
+            build_year = building_info[0]
+            structure = building_info[1] if len(building_info) > 1 else None
+        else:
+            build_year = None
+            structure = building_info
+        info_dict.update({
+            'floor_level': floor_info.split('(')[0],
+            'total_floor': search.group() if search else None,
+            'build_year': build_year,
+            'structure': structure
+        })
+
+        house_tag = _first(self.DEAL_HOUSE, item_tag)
+        if house_tag is not None:
+            house_text = house_tag.text_content()
+            info_dict.update({
+                'tax_free_tag': int('房屋满五年' in house_text),
+                'subway_tag': int('近地铁' in house_text)
+            })
+
+        deal_info = _first(self.DEAL_CYCLE, item_tag)
+        if deal_info is not None:
+            deal_info = self.SPAN(deal_info)
+            info_dict.update({'put_price': re.search(r'\d+', deal_info[0].text_content()).group()})
+            if len(deal_info) > 1:
+                info_dict.update({'deal_period': re.search(r'\d+', deal_info[1].text_content()).group()})
+
+        return info_dict
+
+
+def _range_price(span):
+    """ 成交价可能为区间(如 300-320)，取均值 """
+    if span is None:
+        return None
+    price = span.text_content()
+    if '-' in price:
+        prices = [int(x) for x in price.split('-')]
+        return sum(prices) / 2
+    return price
+
+
+PARSERS = {
+    'bs4': Bs4Parser,
+    'lxml': LxmlParser,
+}
+
+LIST_ITEM_PARSERS = {
+    'sale_info': 'sale_item',
+    'community_info': 'community_item',
+    'transaction_info': 'transaction_item',
+}
+
+DETAIL_PARSERS = {
+    'sale_info': 'sale_details',
+    'community_info': 'community_details',
+}
+
+
+def parse_list_page(parser, module, content):
+    """
+    解析列表页全部条目(在售/小区仅导航页部分)，可在子进程中执行
+    :return: (解析结果列表, 解析失败信息列表)
+    """
+    item_parser = getattr(parser, LIST_ITEM_PARSERS[module])
+    records, errors = [], []
+    for item_tag in parser.list_items(module, content):
+        try:
+            records.append(item_parser(item_tag))
+        except Exception as e:
+            errors.append(repr(e))
+    return records, errors
+
+
+def parse_detail_page(parser, module, content):
+    """ 解析详情页，可在子进程中执行 """
+    return getattr(parser, DETAIL_PARSERS[module])(content)
+
+
+def timed_parse(fn, parser, module, content):
+    """ 解析并返回(结果, 耗时)，在解析进程中计时，不含进程池排队时间 """
+    t0 = time.time()
+    return fn(parser, module, content), time.time() - t0
+
+
+class PageError(Exception):
+    """ 列表页请求或解析失败 """
+
+
+def record_items(module, key, records, errors):
+    """ 记录列表页解析出的条目数和解析失败的条目数 """
+    metrics.inc('items_parsed_total', len(records), module=module, key=key)
+    if errors:
+        metrics.inc('parse_failures_total', len(errors), module=module, stage='list_item')
+
+
+# 链家列表最多显示100页，达到上限的查询按筛选条件拆分
+PAGE_LIMIT = 100
+
+LIST_URL_PREFIX = {
+    'sale_info': 'ershoufang',
+    'community_info': 'xiaoqu',
+    'transaction_info': 'chengjiao',
+}
+
+# 可拆分查询的筛选条件，按拆分顺序：价格(p)、面积(a)、户型(l)
+FACETS = {
+    'sale_info': [('p', range(1, 9)), ('a', range(1, 9)), ('l', range(1, 7))],
+    'transaction_info': [('a', range(1, 9)), ('l', range(1, 7))],
+}
+
+
+def split_filters(module, filters=''):
+    """ 按下一个未使用的筛选条件拆分，没有可用条件时返回空列表 """
+    for facet, values in FACETS.get(module, []):
+        if not re.search(facet + r'\d', filters):
+            return [filters + f'{facet}{x}' for x in values]
+    return []
+
+
+class LianJiaSpider:
+    """
+    链家二手房爬虫
+
+    分为三个部分：
+    1）在售房源：sale_info, 全量更新；
+    2）小区信息：community_info，增量更新；
+    3) 历史成交：transaction_info，增量更新；
+
+    支持 - 城市选择：1个
+    支持 - 通过指定区县爬取（粗粒度）；
+    支持 - 通过搜索商圈或小区爬取（细粒度）；
+    """
+
+    def __init__(self, city, districts, backend='bs4'):
+        self.base_url = f"http://{city}.lianjia.com/"
+        self.city = city
+        self.districts = districts
+
+        self.parser = PARSERS[backend]()
+        self.max_workers = 3
+        self.detail_workers = 0  # 0: 详情页在列表页任务内串行请求
+        self.detail_queue_size = 200
+        self.batch_size = 500
+        self.detail_cache = None
+        self.parse_workers = 0  # 0: 在爬取线程内解析
+        self.parse_pool = None
+        self.pipeline = None
+        self.writer = None
+        self.archive = None
+        self.replay = None
+        self.storage = 'snapshot'  # 在售房源存储方式：snapshot-每日全量写入sale_info；delta-增量写入sale_listing/sale_observation
+        self.hints = CrawlHints()
+        self.probe_ttl = None  # 总页数记录在此时间内时直接使用，不查询总页数
+        self.first_pages = {}  # 查询总页数时下载的第1页，url -> content，爬取第1页时直接使用
+        self.request_params = dict(retry=2, timeout=10, auto_proxy=False, delay=0.5)
+        self.request_fn = self.build_request_fn()
+        self.metrics_report = None
+
+    def build_request_fn(self):
+        """ 回放模式从存档读取，否则请求网络(可选存档) """
+        if self.replay:
+            return self.replay
+        return functools.partial(request_data, archive=self.archive, **self.request_params)
+
+    def set_request_params(self, max_workers, delay, retry=2, auto_proxy=False, detail_workers=0):
+        """ 设置request参数 """
+        self.max_workers = max_workers
+        self.detail_workers = detail_workers
+        session_manager.configure(pool_maxsize=max_workers + detail_workers)
+        if delay:
+            # 限速器的速率只在建桶时按delay初始化，之前爬取调整过的速率需按新的delay重置
+            rate_limiter.set_rate(urlparse(self.base_url).netloc, 1 / delay)
+        self.request_params = dict(retry=retry, timeout=10, auto_proxy=auto_proxy, delay=delay)
+        self.request_fn = self.build_request_fn()
+
+    def set_archive(self, archive):
+        """ 存档所有请求到的网页，archive为HtmlArchive，None关闭 """
+        self.archive = archive
+        self.request_fn = self.build_request_fn()
+
+    def set_replay(self, archive, crawl_date=None):
+        """ 回放模式：从存档读取crawl_date(默认最新)的网页，不请求网络；archive为None关闭 """
+        self.replay = functools.partial(archive.read, crawl_date=crawl_date) if archive else None
+        self.request_fn = self.build_request_fn()
+
+    def set_parser(self, backend):
+        """ 切换解析器：bs4 / lxml """
+        self.parser = PARSERS[backend]()
+
+    def set_parse_workers(self, parse_workers):
+        """ 解析进程数，>0时批量爬取使用进程池解析网页，绕开GIL """
+        self.parse_workers = parse_workers
+
+    def set_storage(self, storage):
+        """ 在售房源存储方式：snapshot / delta，delta模式下可通过视图sale_snapshot查询每日快照 """
+        self.storage = storage
+
+    def set_probe_hints(self, hours=24):
+        """
+        上次爬取的总页数记录在hours小时内时直接按记录的页数爬取，跳过总页数查询；hours=0关闭
+        注意：期间页数增加时末尾的页会漏爬
+        """
+        self.probe_ttl = datetime.timedelta(hours=hours) if hours else None
+
+    def set_metrics(self, report=None, port=None):
+        """
+        爬取指标导出(见metrics.py)
+        :param report: 每次批量爬取结束时写入JSON运行报告的路径
+        :param port: 不为空时启动HTTP服务，/metrics为Prometheus文本格式
+        """
+        self.metrics_report = report
+        if port:
+            metrics.serve(port)
+
+    def set_detail_cache(self, ttl_days=30):
+        """
+        启用在售房源详情页缓存，ttl_days为缓存有效天数；ttl_days=0关闭
+        缓存不含每天变化的关注人数(follow)，只在delta存储模式下使用(缺失的follow沿用上一条观测)；
+        snapshot模式每天的快照都需要follow，仍请求详情页
+        """
+        self.detail_cache = DetailCache(ttl_days=ttl_days).load() if ttl_days else None
+
+    def get_total_pages(self, url):
+        """ 总页码数 """
+        content = self.request_fn(url)
+        if not content:
+            return 0
+        return self.parse_total_pages(content)
+
+    def parse_total_pages(self, content):
+        """ 解析列表页总页码数 """
+        return self.parser.total_pages(content)
+
+    def list_url(self, module, scope, key, page=None, filters=''):
+        """ 列表页url，scope: district/search，filters为筛选条件(如p3a2) """
+        path = (f'pg{page}' if page else '') + filters
+        if scope == 'district':
+            return self.base_url + f"{LIST_URL_PREFIX[module]}/{key}/" + (path and path + '/')
+        return self.base_url + f"{LIST_URL_PREFIX[module]}/{path}rs{key}/"
+
+    def probe_total_pages(self, module, scope, key, filters=''):
+        """ 下载第1页查询总页数并记录，第1页留给爬取时直接使用；请求失败时返回None，不记录 """
+        url = self.list_url(module, scope, key, page=1, filters=filters)
+        content = self.request_fn(url)
+        if not content:
+            return None
+        total_pages = self.parse_total_pages(content)
+        self.hints.put(module, scope, key, filters, total_pages)
+        if total_pages:
+            self.first_pages[url] = content
+        return total_pages
+
+    def hinted_total_pages(self, module, scope, key, filters=''):
+        """ 可直接使用的总页数记录：probe_ttl内的记录，或上次已达上限(将被拆分)的记录 """
+        total_pages = self.hints.get(module, scope, key, filters, ttl=self.probe_ttl) if self.probe_ttl else None
+        if total_pages is None and split_filters(module, filters):
+            total_pages = self.hints.get(module, scope, key, filters)
+            if total_pages is not None and total_pages < PAGE_LIMIT:
+                total_pages = None
+        return total_pages
+
+    def split_query(self, module, scope, key, filters=''):
+        """
+        查询总页数达到PAGE_LIMIT时按筛选条件递归拆分，直至每个子查询都在上限内
+        上次已达上限的查询(见hints)直接拆分，不再查询总页数
+        :return: [(filters, total_pages), ...]
+        """
+        total_pages = self.hinted_total_pages(module, scope, key, filters)
+        if total_pages is None:
+            total_pages = self.probe_total_pages(module, scope, key, filters) or 0
+
+        children = split_filters(module, filters)
+        if total_pages < PAGE_LIMIT or not children:
+            return [(filters, total_pages)] if total_pages else []
+        self.first_pages.pop(self.list_url(module, scope, key, page=1, filters=filters), None)
+        logging.info("@split_query: {0} - {1}{2} - {3} pages, split into {4}".format(
+            module, key, filters, total_pages, len(children)))
+        return [x for child in children for x in self.split_query(module, scope, key, child)]
+
+    def parse_list_items(self, module, content):
+        """ 列表页条目 """
+        return self.parser.list_items(module, content)
+
+    def parse_sale_content(self, item_tag):
+        """ 在售房源列表 单条解析(含详情页) """
+        info_dict = self.parse_sale_item(item_tag)
+        if not self.load_cached_sale_details(info_dict):
+            info_dict.update(self.parse_details_cached('sale_info', info_dict, self.request_fn(info_dict['link'])))
+        return info_dict
+
+    def load_cached_sale_details(self, info_dict):
+        """ 详情页缓存命中时合并静态字段，返回是否命中 """
+        if not self.detail_cache or self.storage != 'delta':
+            return False
+        details = self.detail_cache.get(info_dict['house_id'], info_dict['total_price'])
+        if details is None:
+            return False
+        info_dict.update(details)
+        return True
+
+    def parse_details_cached(self, module, info_dict, content):
+        """ 解析详情页(可在解析进程池中执行)，在售房源写入详情页缓存 """
+        details = self.run_parse(parse_detail_page, module, content).result()
+        if module == 'sale_info' and self.detail_cache:
+            self.detail_cache.put(info_dict['house_id'], info_dict['total_price'], details)
+        return details
+
+    def parse_sale_item(self, item_tag):
+        """ 在售房源列表 单条解析(仅导航页) """
+        return self.parser.sale_item(item_tag)
+
+    def parse_sale_details(self, content):
+        """ 在售房源详情页解析 """
+        return self.parser.sale_details(content)
+
+    def parse_community_content(self, item_tag):
+        """ 小区列表 单条解析(含详情页) """
+        info_dict = self.parse_community_item(item_tag)
+        info_dict.update(self.parse_details_cached('community_info', info_dict, self.request_fn(info_dict['link'])))
+        return info_dict
+
+    def parse_community_item(self, item_tag):
+        """ 小区列表 单条解析(仅导航页) """
+        return self.parser.community_item(item_tag)
+
+    def parse_community_details(self, content):
+        """ 小区详情页解析 """
+        return self.parser.community_details(content)
+
+    def parse_transaction_content(self, item_tag):
+        """ 成交列表 单条解析 """
+        return self.parser.transaction_item(item_tag)
+
+    def penalize(self):
+        """ 解析失败多为验证码或不完整页面，降低该站点的请求速率 """
+        rate_limiter.penalize(urlparse(self.base_url).netloc)
+
+    def run_parse(self, fn, module, content):
+        """ 有解析进程池时提交到进程池，否则在当前线程解析；返回Future """
+        future = Future()
+
+        def done(timed):
+            try:
+                result, cost = timed.result()
+            except Exception as e:
+                metrics.inc('parse_failures_total', module=module, stage=fn.__name__)
+                future.set_exception(e)
+                return
+            metrics.observe('parse_seconds', cost, module=module, stage=fn.__name__)
+            future.set_result(result)
+
+        if self.parse_pool:
+            self.parse_pool.submit(timed_parse, fn, self.parser, module, content).add_done_callback(done)
+            return future
+
+        timed = Future()
+        try:
+            timed.set_result(timed_parse(fn, self.parser, module, content))
+        except Exception as e:
+            timed.set_exception(e)
+        done(timed)
+        return future
+
+    def crawl_list_page(self, module, url_page, key, page):
+        """ 爬取并解析一页列表(含详情页)，返回解析结果；列表页请求或解析失败(含全部条目解析失败)时返回None，以区别于空页 """
+        content = self.first_pages.pop(url_page, None) or self.request_fn(url_page)
+        logging.debug('@crawl_{0}: {1} - page - {2}: {3}'.format(module, key, page, url_page))
+        if not content:
+            logging.error('@crawl_{0}: {1} - page - {2}: empty content.'.format(module, key, page))
+            return None
+
+        try:
+            records, errors = self.run_parse(parse_list_page, module, content).result()
+        except Exception as e:
+            logging.exception('@crawl_{0}: {1} - page - {2}: {3}'.format(module, key, page, e))
+            return None
+        record_items(module, key, records, errors)
+        for error in errors:
+            logging.error('@crawl_{0}: {1} - page - {2}: {3}'.format(module, key, page, error))
+            self.penalize()
+        if errors and not records:
+            # 全部条目解析失败(如页面结构异常)，视为解析失败而不是空页
+            return None
+        if module == 'transaction_info':
+            return records
+
+        if self.pipeline:
+            return self.emit_detail_tasks(module, records, key)
+
+        # 详情页依次请求，解析交给run_parse(进程池模式下与请求并行)
+        tasks = []
+        for info_dict in records:
+            if module == 'sale_info' and self.load_cached_sale_details(info_dict):
+                tasks.append((info_dict, None))
+                continue
+            detail_content = self.request_fn(info_dict['link'])
+            if not detail_content:
+                # 请求失败已由request_data记录并反馈限速器，不再解析和降速
+                logging.error('@crawl_{0}: {1} - page - {2}: {3} - empty content.'.format(
+                    module, key, page, info_dict['link']))
+                continue
+            tasks.append((info_dict, self.run_parse(parse_detail_page, module, detail_content)))
+
+        results = []
+        for info_dict, future in tasks:
+            if future:
                 try:
-                    info_dict = self.parse_transaction_content(item_tag)
-                    query = session.query(TransactionInfo).filter(TransactionInfo.id == info_dict['id'])
-                    if query.first():
-                        query.update(info_dict)
-                    else:
-                        session.add(TransactionInfo(**info_dict))
-                    session.commit()
-                    logging.debug('@crawl_transaction_by_search: {0} - page - {1}: {2}'.format(
-                        search_key, page, info_dict))
+                    details = future.result()
                 except Exception as e:
-                    logging.exception('@crawl_transaction_by_search: {0} - page - {1}: {2}'.format(
-                        search_key, page, e))
-                    time.sleep(3)
+                    logging.exception('@crawl_{0}: {1} - page - {2}: {3} - {4}'.format(
+                        module, key, page, info_dict['link'], e))
+                    self.penalize()
+                    continue
+                if module == 'sale_info' and self.detail_cache:
+                    self.detail_cache.put(info_dict['house_id'], info_dict['total_price'], details)
+                info_dict.update(details)
+            logging.debug('@crawl_{0}: {1} - page - {2}: {3}'.format(module, key, page, info_dict))
+            results.append(info_dict)
+        return results
+
+    def emit_detail_tasks(self, module, records, key=''):
+        """ 流水线模式：列表页条目交给详情页线程池，合并结果由writer入库 """
+        def sink(record):
+            self.writer.add(module, (key, record))
+
+        for info_dict in records:
+            if module == 'sale_info' and self.load_cached_sale_details(info_dict):
+                sink(info_dict)
+            else:
+                self.pipeline.put(info_dict, functools.partial(self.parse_details_cached, module, info_dict), sink)
+        return []
+
+    @contextmanager
+    def crawl_context(self, buffered=True):
+        """
+        批量爬取上下文：解析结果按batch_size批量入库，buffered=False时每页爬取后同步入库；
+        parse_workers > 0 时启用解析进程池，detail_workers > 0 时启用详情页流水线
+        """
+        self.writer = BatchWriter(self.save_records, batch_size=self.batch_size) if buffered else None
+        if self.parse_workers:
+            self.parse_pool = ProcessPoolExecutor(max_workers=self.parse_workers)
+        if self.detail_workers:
+            self.pipeline = DetailPipeline(
+                self.request_fn, workers=self.detail_workers, maxsize=self.detail_queue_size).start()
+        try:
+            yield
+        finally:
+            if self.pipeline:
+                self.pipeline.close()
+            if self.parse_pool:
+                self.parse_pool.shutdown()
+            if self.writer:
+                self.writer.flush()
+            if self.archive:
+                self.archive.commit()
+            if self.detail_cache:
+                self.detail_cache.flush()
+                logging.info('@detail_cache: {0}'.format(self.detail_cache.stats()))
+            logging.info('@rate_limiter: {0}'.format(rate_limiter.snapshot()))
+            if self.metrics_report:
+                metrics.write_report(self.metrics_report)
+            self.pipeline = None
+            self.parse_pool = None
+            self.writer = None
+            self.first_pages = {}
+
+    def persist(self, module, records, key=''):
+        """ 批量爬取时写入缓冲区，否则直接入库；key为区县/搜索条件，用于按key统计入库条数 """
+        items = [(key, x) for x in records]
+        if self.writer:
+            self.writer.extend(module, items)
+            return
+
+        self.save_records(module, items)
+        if self.detail_cache:
+            self.detail_cache.flush()
+
+    def save_records(self, module, items):
+        """ 解析结果入库，items为[(key, record), ...]，同一批次可包含多个key """
+        if module == 'sale_info':
+            items = [(key, x) for key, x in items if x.get('house_id') and x.get('community_id') and x.get('district')]
+        if not items:
+            return
+
+        with metrics.timer('db_write_seconds', module=module):
+            written = self.write_records(module, [x for _, x in items])
+        for (key, _), ok in zip(items, written):
+            metrics.inc('rows_written_total' if ok else 'db_write_failures_total', module=module, key=key)
+
+    def write_records(self, module, records):
+        """ 写入数据库，返回每条记录是否写入成功；批量写入失败时逐条重试，避免一条异常记录导致整批丢失 """
+        if module == 'sale_info':
+            write = save_sale_delta if self.storage == 'delta' else functools.partial(bulk_insert, SaleInfo)
+        else:
+            write = functools.partial(upsert, CommunityInfo if module == 'community_info' else TransactionInfo)
+        try:
+            write(records)
+            return [True] * len(records)
+        except Exception as e:
+            logging.exception('@save_{0}: batch of {1} failed, retry one by one: {2}'.format(
+                module, len(records), e))
+        written = []
+        for info_dict in records:
+            try:
+                write([info_dict])
+                written.append(True)
+            except Exception as e:
+                logging.exception('@save_{0}: {1} - {2}'.format(
+                    module, info_dict.get('id') or info_dict.get('house_id'), e))
+                written.append(False)
+        return written
 
-        logging.info('@crawl_transaction_by_search: {0} - page - {1} complete.'.format(search_key, page))
+    def crawl_sale_by_district(self, args):
+        """ 根据区县爬取一页在售房源，返回列表页是否爬取成功 """
+        district, page = args[:2]
+        filters = args[2] if len(args) > 2 else ''
+        url_page = self.list_url('sale_info', 'district', district, page, filters)
+        records = self.crawl_list_page('sale_info', url_page, district + filters, page)
+        if records is None:
+            return False
+        self.persist('sale_info', records, district + filters)
+        logging.info('@crawl_sale_by_page: {0} - page - {1} complete.'.format(district, page))
+        return True
 
-    def crawl_search_pool(self, module, collection, max_pages=100, coll_start=1):
-        """ 依据商圈或小区批量爬取 """
+    def crawl_community_by_district(self, args):
+        """ 根据区县爬取一页小区信息，返回列表页是否爬取成功 """
+        district, page = args[:2]
+        filters = args[2] if len(args) > 2 else ''
+        url_page = self.list_url('community_info', 'district', district, page, filters)
+        records = self.crawl_list_page('community_info', url_page, district + filters, page)
+        if records is None:
+            return False
+        self.persist('community_info', records, district + filters)
+        logging.info('@crawl_community_by_district: {0} - page - {1} complete.'.format(district, page))
+        return True
 
-        total_cnt = len(collection)
-        logging.info("@crawl_{0}: total {1} found".format(module, total_cnt))
+    def crawl_district_pool(self, module, max_pages=100):
+        """ 依据地区批量爬取 """
 
-        crawl_mapper = {
-            'sale_info': {
-                'url': 'ershoufang',
-                'func': self.crawl_sale_by_search
-            },
-            'transaction_info':  {
-                'url': 'chengjiao',
-                'func': self.crawl_transaction_by_search
-            },
-        }
-        url_prefix = crawl_mapper[module]['url']
-        crawl_function = crawl_mapper[module]['func']
+        crawl_function = {
+            'sale_info': self.crawl_sale_by_district,
+            'community_info': self.crawl_community_by_district,
+        }[module]
+
+        # 所有区县共用一个线程池，线程内的Session和keep-alive连接在整个爬取过程中复用
+        with self.crawl_context(), ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for district in self.districts:
+                queries = self.split_query(module, 'district', district)
+                total_pages = sum(min(x[1], max_pages) for x in queries)
+                logging.info("@crawl_{0}: total {1} pages found for {2} in {3} queries".format(
+                    module, total_pages, district, len(queries)))
+
+                if not total_pages:
+                    logging.exception("@crawl_{0}: no pages found for {1}".format(
+                        module, district))
+                    continue
+
+                args = [(district, page + 1, filters)
+                        for filters, pages in queries for page in range(min(pages, max_pages))]
+                all_task = [executor.submit(crawl_function, arg) for arg in args]
+                for future in as_completed(all_task):
+                    future.result()
+
+                logging.info("@crawl_{0}: {1} - all {2} pages complete.".format(
+                    module, district, total_pages))
 
-        for i, search_key in enumerate(collection):
+    def crawl_sale_by_search(self, args):
+        """ 根据商圈或社区爬取一页在售房源，返回列表页是否爬取成功 """
+        search_key, page = args[:2]
+        filters = args[2] if len(args) > 2 else ''
+        url_page = self.list_url('sale_info', 'search', search_key, page, filters)
+        records = self.crawl_list_page('sale_info', url_page, search_key + filters, page)
+        if records is None:
+            return False
+        self.persist('sale_info', records, search_key + filters)
+        logging.info('@crawl_sale_by_search: {0} - page - {1} complete.'.format(search_key, page))
+        return True
 
-            # 指定开始，方便中断后继续爬取
-            if i + 1 < coll_start:
-                continue
+    def crawl_transaction_by_search(self, args):
+        """ 依据商圈或小区 爬取一页历史成交房源，返回列表页是否爬取成功 """
+        search_key, page = args[:2]
+        filters = args[2] if len(args) > 2 else ''
+        url_page = self.list_url('transaction_info', 'search', search_key, page, filters)
+        records = self.crawl_list_page('transaction_info', url_page, search_key + filters, page)
+        if records is None:
+            return False
+        self.persist('transaction_info', records, search_key + filters)
+        logging.info('@crawl_transaction_by_search: {0} - page - {1} complete.'.format(search_key, page))
+        return True
+
+    def crawl_transaction_incremental(self, search_key, max_pages=100, lookback_days=30):
+        """
+        增量爬取一个商圈/小区的历史成交(按成交时间倒序)：逐页爬取，只入库新成交，
+        某页全部为已入库的成交或早于水位线(上次爬取的最新成交日期 - lookback_days)时停止翻页
+        lookback_days: 链家成交记录有延迟上架，水位线前lookback_days天内的成交仍视为可能新增
+        有页面请求失败时不更新水位线，并标记backfill，下次爬到水位线日期为止
+        """
+        module = 'transaction_info'
+        hint = self.hints.hint(module, 'search', search_key)
+        watermark, backfill = hint.get('watermark'), hint.get('backfill')
+        cutoff = None
+        if watermark:
+            cutoff = datetime.datetime.strptime(watermark, '%Y-%m-%d') - datetime.timedelta(days=lookback_days)
+            cutoff = cutoff.strftime('%Y-%m-%d')
+        latest = watermark or ''
+        total_pages = self.probe_total_pages(module, 'search', search_key)
+        if total_pages is None:
+            logging.error('@crawl_transaction_incremental: {0} - total pages request failed'.format(search_key))
+            return
+        total_pages = min(total_pages, max_pages)
+
+        failed = False
+        for page in range(1, total_pages + 1):
+            url_page = self.list_url(module, 'search', search_key, page)
+            records = self.crawl_list_page(module, url_page, search_key, page)
+            if records is None:
+                # 失败页的成交可能在下次爬取时已被后续新成交挤到已入库的页之后，需按水位线日期补爬
+                failed = True
+                logging.error('@crawl_transaction_incremental: {0} - page {1} failed, backfill next time'.format(
+                    search_key, page))
+                break
+            if not records:
+                break
+
+            known = self.query_transaction_ids([x['id'] for x in records])
+            self.persist(module, [x for x in records if x['id'] not in known], search_key)
+            deal_dates = [x['deal_date'] for x in records if re.match(r'\d{4}-\d{2}-\d{2}$', x.get('deal_date') or '')]
+            latest = max([latest] + deal_dates)
+            # 上次有失败页时不因已入库停止，爬到水位线日期为止
+            if all((x['id'] in known and not backfill) or (cutoff and x['deal_date'] < cutoff) for x in records):
+                logging.info('@crawl_transaction_incremental: {0} - stop at page {1}'.format(search_key, page))
+                break
+        else:
+            if total_pages >= PAGE_LIMIT:
+                logging.warning('@crawl_transaction_incremental: {0} - reach page limit, backfill needed'.format(
+                    search_key))
 
-            url = self.base_url + f"{url_prefix}/rs{search_key}/"
-            total_pages = self.get_total_pages(url)
-            total_pages = min(total_pages, max_pages)
-            logging.info("@crawl_{0}: {1}/{2} - {3} - total {4} pages found.".format(
-                module, i + 1, total_cnt, search_key, total_pages))
-            if not total_pages:
-                continue
+        if failed:
+            self.hints.save(module, 'search', search_key, '', backfill=1)
+        elif latest or backfill:
+            self.hints.save(module, 'search', search_key, '', watermark=latest or None, backfill=0)
+
+    def crawl_search_pool(self, module, collection, max_pages=100, coll_start=1, incremental=False):
+        """
+        依据商圈或小区批量爬取
+        incremental: 仅transaction_info，增量模式，每个商圈/小区爬到已入库的成交为止，不拆分查询
+        """
+
+        total_cnt = len(collection)
+        logging.info("@crawl_{0}: total {1} found".format(module, total_cnt))
+
+        crawl_function = {
+            'sale_info': self.crawl_sale_by_search,
+            'transaction_info': self.crawl_transaction_by_search,
+        }[module]
 
+        with self.crawl_context():
+            # 增量模式下每个商圈/小区依次翻页，多个商圈/小区并行
             executor = ThreadPoolExecutor(max_workers=self.max_workers)
-            args = [(search_key, page + 1) for page in range(total_pages)]
-            all_task = [executor.submit(crawl_function, arg) for arg in args]
-            for future in as_completed(all_task):
+            incremental_tasks = []
+            for i, search_key in enumerate(collection):
+
+                # 指定开始，方便中断后继续爬取
+                if i + 1 < coll_start:
+                    continue
+
+                if incremental and module == 'transaction_info':
+                    incremental_tasks.append(executor.submit(self.crawl_transaction_incremental, search_key, max_pages))
+                    continue
+
+                queries = self.split_query(module, 'search', search_key)
+                total_pages = sum(min(x[1], max_pages) for x in queries)
+                logging.info("@crawl_{0}: {1}/{2} - {3} - total {4} pages found.".format(
+                    module, i + 1, total_cnt, search_key, total_pages))
+                if not total_pages:
+                    continue
+
+                args = [(search_key, page + 1, filters)
+                        for filters, pages in queries for page in range(min(pages, max_pages))]
+                all_task = [executor.submit(crawl_function, arg) for arg in args]
+                for future in as_completed(all_task):
+                    future.result()
+                logging.info("@crawl_{0}: {1}/{2} - {3} - all {4} pages complete.".format(
+                    module, i + 1, total_cnt, search_key, total_pages))
+
+            for future in as_completed(incremental_tasks):
                 future.result()
-            logging.info("@crawl_{0}: {1}/{2} - {3} - all {4} pages complete.".format(
-                module, i + 1, total_cnt, search_key, total_pages))
-            time.sleep(1)
+            executor.shutdown()
+
+    def frontier_targets(self):
+        """ (module, scope) -> 单页爬取函数 """
+        return {
+            ('sale_info', 'district'): self.crawl_sale_by_district,
+            ('community_info', 'district'): self.crawl_community_by_district,
+            ('sale_info', 'search'): self.crawl_sale_by_search,
+            ('transaction_info', 'search'): self.crawl_transaction_by_search,
+        }
+
+    def crawl_frontier_task(self, frontier, task, max_pages=100):
+        """
+        执行一个任务；第1页任务负责查询总页码数并添加其余页的任务，
+        总页数达到PAGE_LIMIT时改为添加拆分后子查询的第1页任务
+        """
+        crawl_function = self.frontier_targets()[(task.module, task.scope)]
+        try:
+            if task.page == 1:
+                children = split_filters(task.module, task.filters)
+                total_pages = self.hinted_total_pages(task.module, task.scope, task.search_key, task.filters)
+                if total_pages is None:
+                    total_pages = self.probe_total_pages(task.module, task.scope, task.search_key, task.filters)
+                if total_pages is None:
+                    raise PageError('total pages request failed')
+                logging.info("@crawl_{0}: total {1} pages found for {2}{3}".format(
+                    task.module, total_pages, task.search_key, task.filters))
+                if total_pages >= PAGE_LIMIT and children:
+                    self.first_pages.pop(self.list_url(
+                        task.module, task.scope, task.search_key, page=1, filters=task.filters), None)
+                    for child in children:
+                        frontier.seed(task.module, task.scope, [task.search_key], filters=child)
+                    frontier.complete(task)
+                    return
+                total_pages = min(total_pages, max_pages)
+                frontier.seed(task.module, task.scope, [task.search_key],
+                              pages=range(2, total_pages + 1), filters=task.filters)
+                if not total_pages:
+                    frontier.complete(task)
+                    return
+            if not crawl_function((task.search_key, task.page, task.filters)):
+                raise PageError('list page request or parse failed')
+            frontier.complete(task)
+        except Exception as e:
+            logging.exception('@crawl_{0}: {1}{2} - page - {3}: {4}'.format(
+                task.module, task.search_key, task.filters, task.page, e))
+            frontier.fail(task, e)
+
+    def crawl_frontier(self, frontier, max_pages=100, poll_interval=10):
+        """
+        从持久化任务队列(frontier.Frontier)领取任务爬取，多个进程/机器可同时运行
+        任务通过 frontier.seed(module, 'district'/'search', keys) 添加，只需添加第1页
+        每页的记录入库后才标记任务完成，进程中断时未入库的任务在租约过期后被重新领取；
+        因此不使用写入缓冲区，也不支持详情页流水线(detail_workers)
+        """
+        if self.detail_workers:
+            raise ValueError('crawl_frontier does not support detail_workers, set detail_workers=0')
+        with self.crawl_context(buffered=False), ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                tasks = frontier.claim(self.max_workers)
+                if not tasks:
+                    # 其他爬虫的任务仍在执行时，可能添加新页或租约过期，继续等待
+                    if not frontier.active():
+                        break
+                    time.sleep(poll_interval)
+                    continue
+                list(executor.map(functools.partial(self.crawl_frontier_task, frontier, max_pages=max_pages), tasks))
+        logging.info("@crawl_frontier: {0} - {1}".format(frontier.crawl_date, frontier.stats()))
+
+    @classmethod
+    def query_transaction_ids(cls, ids):
+        """ 已入库的成交记录id """
+        session = DBSession()
+        query = session.query(TransactionInfo.id) \
+            .filter(TransactionInfo.id.in_(ids)) \
+            .all()
+        session.close()
+        return set([x[0] for x in query])
 
     @classmethod
     def query_biz_circle(cls, districts):
@@ -547,10 +1377,10 @@ class LianJiaSpider:
         session = DBSession()
         query = session.query(CommunityInfo.biz_circle) \
             .filter(CommunityInfo.district.in_(districts)) \
-            .all()
+            .distinct()
+        result = [x[0] for x in query]
         session.commit()
         session.close()
-        result = list(set([x[0] for x in query]))
         result.sort()
         return result
 
@@ -558,19 +1388,16 @@ class LianJiaSpider:
     def query_community(cls, districts=None, biz_circle=None):
         """ 查小区 """
         session = DBSession()
+        query = session.query(CommunityInfo.community).distinct()
         if districts:
-            query = session.query(CommunityInfo.community) \
-                .filter(CommunityInfo.district.in_(districts)) \
-                .all()
+            query = query.filter(CommunityInfo.district.in_(districts))
         elif biz_circle:
-            query = session.query(CommunityInfo.community) \
-                .filter(CommunityInfo.biz_circle.in_(biz_circle)) \
-                .all()
+            query = query.filter(CommunityInfo.biz_circle.in_(biz_circle))
         else:
-            query = [[]]
+            query = []
             logging.exception("@query_community: query condition un-defined.")
+        result = [x[0] for x in query]
         session.commit()
         session.close()
-        result = list(set([x[0] for x in query]))
         result.sort()
         return result
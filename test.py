@@ -1,7 +1,36 @@
 # -*- coding: utf-8 -*-
+import datetime
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
 import warnings
 from unittest import TestCase
-from spider import LianJiaSpider
+
+import pyarrow.parquet as pq
+
+from model import SaleInfo, SaleListing, SaleObservation, SaleDetailCache, CommunityInfo, TransactionInfo, SaleRollup, \
+    TransactionRollup, DBSession, init_db, set_engine, upsert, bulk_insert
+from settings import DB_URL, PROXY_DB_URL
+from snapshot import save_sale_delta
+from spider import LianJiaSpider, PARSERS, PAGE_LIMIT, split_filters
+from async_spider import AsyncLianJiaSpider
+from archive import HtmlArchive
+from cache import DetailCache
+from events import diff_prices
+from export import export_table, load_watermarks
+from pipeline import DetailPipeline
+from proxy import ProxyPool, ScoredProxyPool, proxy_engine
+from frontier import Frontier
+from metrics import Metrics, metrics
+from hints import CrawlHints
+from reader import iter_frames
+from rollup import rollup_sale, rollup_transaction
+from utils import RateLimiter, SessionManager
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
 
 
 class TestSpider(TestCase):
@@ -42,6 +71,12 @@ class TestSpider(TestCase):
         collection = self.spider.query_community(biz_circle=['中关村', '五道口'])
         self.spider.crawl_search_pool(module='transaction_info', collection=collection, max_pages=3)
 
+    def test_crawl_frontier(self):
+        frontier = Frontier(crawl_date='test')
+        frontier.seed('sale_info', 'search', ['新龙城'])
+        self.spider.crawl_frontier(frontier, max_pages=2)
+        print(frontier.stats())
+
     def test_query_biz_circle(self):
         res = self.spider.query_biz_circle(districts=['大兴', '海淀'])
         print(res)
@@ -51,3 +86,682 @@ class TestSpider(TestCase):
         print(res)
         res = self.spider.query_community(biz_circle=['中关村', '五道口'])
         print(res)
+
+    def test_iter_frames(self):
+        for df in iter_frames('transaction_info', districts=['海淀'], batch_size=1000):
+            print(df.dtypes)
+            break
+
+
+class TestAsyncSpider(TestCase):
+
+    def setUp(self):
+        self.spider = AsyncLianJiaSpider(city="bj", districts=['haidian'], concurrency=20)
+        warnings.simplefilter("ignore", ResourceWarning)
+
+    def test_crawl_sale_by_district_pool(self):
+        self.spider.crawl_district_pool(module='sale_info', max_pages=3)
+
+    def test_crawl_transaction_by_search_pool(self):
+        collection = self.spider.query_community(biz_circle=['中关村', '五道口'])
+        self.spider.crawl_search_pool(module='transaction_info', collection=collection, max_pages=3)
+
+
+def fixture_archive(root):
+    """ fixtures/下的网页(pages.json记录url -> 文件)写入root下的临时存档 """
+    archive = HtmlArchive(root)
+    with open(os.path.join(FIXTURE_DIR, 'pages.json'), encoding='utf-8') as f:
+        pages = json.load(f)
+    for url, name in pages.items():
+        with open(os.path.join(FIXTURE_DIR, name), encoding='utf-8') as f:
+            archive.write(url, f.read())
+    return archive
+
+
+class TestReplay(TestCase):
+    """ 离线回放网页存档 """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.archive = fixture_archive(self.tmp_dir)
+        self.spider = LianJiaSpider(city="bj", districts=['daxing'])
+        self.spider.set_replay(self.archive)
+
+    def tearDown(self):
+        self.archive.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_total_pages(self):
+        total_pages = self.spider.get_total_pages(url="http://bj.lianjia.com/ershoufang/daxing/")
+        self.assertEqual(type(total_pages), int)
+
+    def test_crawl_sale_list_page(self):
+        records = self.spider.crawl_list_page(
+            'sale_info', "http://bj.lianjia.com/ershoufang/daxing/pg1/", 'daxing', 1)
+        self.assertTrue(records)
+        for record in records:
+            self.assertTrue(record['house_id'] and record['community_id'] and record['district'])
+
+    def assert_backends_equal(self, module, url, key):
+        records = self.spider.crawl_list_page(module, url, key, 1)
+        self.assertTrue(records)
+        self.spider.set_parser('lxml')
+        self.assertEqual(self.spider.crawl_list_page(module, url, key, 1), records)
+        self.spider.set_parser('bs4')
+
+    def test_lxml_backend(self):
+        self.assert_backends_equal('sale_info', "http://bj.lianjia.com/ershoufang/daxing/pg1/", 'daxing')
+        self.assert_backends_equal('community_info', "http://bj.lianjia.com/xiaoqu/changping/pg1/", 'changping')
+        self.assert_backends_equal('transaction_info', "http://bj.lianjia.com/chengjiao/pg1rs新龙城/", '新龙城')
+
+    def test_lxml_class_selector(self):
+        """ 含空格的class_匹配完整的class属性 """
+        with open(os.path.join(FIXTURE_DIR, 'xiaoqu_detail.html'), encoding='utf-8') as f:
+            content = f.read()
+        parsers = [PARSERS['bs4'](), PARSERS['lxml']()]
+        details = [x.community_details(content) for x in parsers]
+        self.assertEqual(details[0], details[1])
+        self.assertIn('year', details[0])
+        content = content.replace('xiaoquDescribe fr', 'xiaoquDescribe fr clear')
+        expected = {'address': '(昌平回龙观)某街道1号', 'follow': '33'}
+        self.assertEqual([x.community_details(content) for x in parsers], [expected, expected])
+
+    def test_crawl_transaction_list_page(self):
+        records = self.spider.crawl_list_page(
+            'transaction_info', "http://bj.lianjia.com/chengjiao/pg1rs新龙城/", '新龙城', 1)
+        self.assertTrue(records)
+
+
+class OfflineTestCase(TestCase):
+    """ 使用临时sqlite数据库的离线测试 """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        set_engine('sqlite:///' + os.path.join(self.tmp_dir, 'house.db'))
+        init_db()
+
+    def tearDown(self):
+        set_engine(DB_URL)
+        shutil.rmtree(self.tmp_dir)
+
+    @staticmethod
+    def query_all(model):
+        session = DBSession()
+        try:
+            return session.query(model).all()
+        finally:
+            session.close()
+
+
+SALE_RECORD = {
+    'house_id': '101', 'title': '测试房源', 'district': '昌平', 'biz_circle': '回龙观', 'community': '新龙城',
+    'community_id': '1111', 'total_price': 358.5, 'unit_price': 50000, 'area': 80.0, 'follow': '12',
+}
+
+
+class TestSaleDelta(OfflineTestCase):
+
+    def observations(self):
+        session = DBSession()
+        try:
+            return session.query(SaleObservation).order_by(SaleObservation.id).all()
+        finally:
+            session.close()
+
+    def test_unchanged_listing(self):
+        for day in range(1, 5):
+            save_sale_delta([dict(SALE_RECORD)], crawl_date=datetime.date(2020, 7, day))
+        observations = self.observations()
+        self.assertEqual(len(observations), 1)
+        self.assertEqual(observations[0].valid_to, datetime.date(2020, 7, 4))
+        self.assertEqual((observations[0].total_price, observations[0].follow), (359, 12))
+
+    def test_price_change(self):
+        save_sale_delta([dict(SALE_RECORD)], crawl_date=datetime.date(2020, 7, 1))
+        save_sale_delta([dict(SALE_RECORD, total_price=350)], crawl_date=datetime.date(2020, 7, 2))
+        save_sale_delta([dict(SALE_RECORD, total_price=350, follow=None)], crawl_date=datetime.date(2020, 7, 3))
+        observations = self.observations()
+        self.assertEqual([(x.total_price, x.valid_from.day, x.valid_to.day) for x in observations],
+                         [(359, 1, 1), (350, 2, 3)])
+
+
+class TestSessionManager(TestCase):
+
+    def test_configure_closes_sessions(self):
+        manager = SessionManager()
+        sess = manager.get_session()
+        self.assertIs(manager.get_session(), sess)
+        closed = []
+        sess.close = lambda: closed.append(sess)
+        manager.configure(pool_maxsize=5)
+        self.assertEqual(closed, [sess])
+        self.assertIsNot(manager.get_session(), sess)
+
+
+class TestDetailPipeline(TestCase):
+
+    def test_close_drains_queue(self):
+        pipeline = DetailPipeline(lambda url: url.upper(), workers=3, maxsize=2).start()
+        results = []
+        for i in range(20):
+            pipeline.put({'link': 'link{0}'.format(i)}, lambda content: {'detail': content}, results.append)
+        pipeline.put({'link': 'bad'}, lambda content: 1 / 0, results.append)
+        pipeline.close()
+        self.assertEqual(sorted(x['detail'] for x in results), sorted('LINK{0}'.format(i) for i in range(20)))
+        self.assertEqual(pipeline._threads, [])
+
+    def test_failed_fetch(self):
+        pipeline = DetailPipeline(lambda url: None if url == 'bad' else url, workers=2).start()
+        parsed, results = [], []
+        for link in ['bad', 'good']:
+            pipeline.put({'link': link}, lambda content: parsed.append(content) or {}, results.append)
+        pipeline.close()
+        self.assertEqual((parsed, results), (['good'], [{'link': 'good'}]))
+
+
+COMMUNITY_RECORD = {'id': '1111', 'community': '新龙城', 'district': '昌平', 'biz_circle': '回龙观'}
+
+
+class TestUpsert(OfflineTestCase):
+
+    def test_upsert_keeps_missing_fields(self):
+        upsert(CommunityInfo, [dict(COMMUNITY_RECORD, price=52000, follow=30),
+                               dict(COMMUNITY_RECORD, id='2222', follow=5)])
+        upsert(CommunityInfo, [dict(COMMUNITY_RECORD, follow=33), dict(COMMUNITY_RECORD, id='3333')], batch_size=1)
+        rows = sorted((x.id, x.price, x.follow) for x in self.query_all(CommunityInfo))
+        self.assertEqual(rows, [('1111', 52000, 33), ('2222', None, 5), ('3333', None, None)])
+
+
+class TestBulkInsert(OfflineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.spider = LianJiaSpider(city="bj", districts=['daxing'])
+        self.records = [dict(SALE_RECORD, house_id=str(x)) for x in range(3)]
+
+    def test_bulk_insert(self):
+        self.assertEqual(bulk_insert(SaleInfo, self.records, batch_size=2), 3)
+        rows = self.query_all(SaleInfo)
+        self.assertEqual(sorted(x.house_id for x in rows), ['0', '1', '2'])
+        self.assertTrue(all(x.create_time and x.put_date is None for x in rows))
+
+    def test_bad_row_in_batch(self):
+        self.records[1]['title'] = None
+        self.assertEqual(self.spider.write_records('sale_info', self.records), [True, False, True])
+        self.assertEqual(sorted(x.house_id for x in self.query_all(SaleInfo)), ['0', '2'])
+
+    def test_bad_row_in_delta_batch(self):
+        self.spider.set_storage('delta')
+        self.records[1]['title'] = None
+        self.assertEqual(self.spider.write_records('sale_info', self.records), [True, False, True])
+        self.assertEqual(sorted(x.house_id for x in self.query_all(SaleListing)), ['0', '2'])
+
+
+class TestDetailCache(OfflineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache = DetailCache(ttl_days=30)
+        cache.put('101', 358, {'district': '昌平', 'layout': '2室1厅1厨1卫', 'follow': '12'})
+        cache.flush()
+
+    def test_hit_and_price_change(self):
+        cache = DetailCache(ttl_days=30).load()
+        self.assertEqual(cache.get('101', 358)['layout'], '2室1厅1厨1卫')
+        self.assertNotIn('follow', cache.get('101', 358))
+        self.assertIsNone(cache.get('101', 350))
+        self.assertIsNone(cache.get('102', 358))
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+    def test_expired(self):
+        session = DBSession()
+        session.query(SaleDetailCache).update({'update_time': datetime.datetime.now() - datetime.timedelta(days=31)})
+        session.commit()
+        session.close()
+        self.assertIsNone(DetailCache(ttl_days=30).load().get('101', 358))
+        self.assertIsNotNone(DetailCache(ttl_days=40).load().get('101', 358))
+
+    def test_snapshot_storage_refetches(self):
+        spider = LianJiaSpider(city="bj", districts=['daxing'])
+        spider.set_detail_cache(ttl_days=30)
+        info_dict = {'house_id': '101', 'total_price': 358}
+        self.assertFalse(spider.load_cached_sale_details(info_dict))
+        spider.set_storage('delta')
+        self.assertTrue(spider.load_cached_sale_details(info_dict))
+        self.assertEqual(info_dict['district'], '昌平')
+
+
+class TestRateLimiter(TestCase):
+
+    def setUp(self):
+        self.limiter = RateLimiter(min_rate=0.5, max_rate=4, increase=1, decrease=0.5, slow_latency=3)
+        self.key = ('bj.lianjia.com', None)
+
+    def rate(self):
+        return self.limiter.snapshot()['bj.lianjia.com|None']['rate']
+
+    def test_aimd(self):
+        self.assertEqual(self.limiter.reserve(self.key, 2), 0)
+        self.limiter.feedback(self.key, True, latency=0.1)
+        self.assertEqual(self.rate(), 3)
+        self.limiter.feedback(self.key, True, latency=0.1)
+        self.limiter.feedback(self.key, True, latency=0.1)
+        self.assertEqual(self.rate(), 4)
+        self.limiter.feedback(self.key, True, latency=5)
+        self.assertEqual(self.rate(), 2)
+        for _ in range(5):
+            self.limiter.feedback(self.key, False, status=503)
+        self.assertEqual(self.rate(), 0.5)
+        self.limiter.penalize('bj.lianjia.com')
+        self.assertEqual(self.rate(), 0.5)
+
+    def test_reserve_wait(self):
+        self.assertEqual(self.limiter.reserve(self.key, 2), 0)
+        self.assertAlmostEqual(self.limiter.reserve(self.key, 2), 0.5, places=2)
+
+    def test_set_rate(self):
+        self.limiter.reserve(self.key, 2)
+        self.limiter.feedback(self.key, False)
+        self.limiter.set_rate('bj.lianjia.com', 10)
+        self.assertEqual(self.rate(), 4)
+        self.limiter.set_rate('sh.lianjia.com', 1)
+        self.assertEqual(self.rate(), 4)
+
+
+class TestScoredProxyPool(TestCase):
+
+    def setUp(self):
+        self.pool = ScoredProxyPool(max_failures=2, flush_every=100)
+        self.pool._thread = True  # 不从数据库加载、不启动后台刷新线程
+        for ip in ['1.1.1.1:80', '2.2.2.2:80']:
+            self.pool._proxies[ip] = {
+                'success': 0, 'failure': 0, 'continuous_failure': 0, 'latency': 1.0, 'last_failure': None}
+
+    def test_report(self):
+        self.pool.report('1.1.1.1:80', True, latency=0.5)
+        self.pool.report('2.2.2.2:80', False)
+        stats = self.pool.stats()
+        self.assertAlmostEqual(stats['1.1.1.1:80']['latency'], 0.9)
+        self.assertGreater(stats['1.1.1.1:80']['score'], stats['2.2.2.2:80']['score'])
+
+        self.pool.report('2.2.2.2:80', True)
+        self.pool.report('2.2.2.2:80', False)
+        self.assertIn('2.2.2.2:80', self.pool.stats())
+        self.pool.report('2.2.2.2:80', False)
+        self.assertEqual(list(self.pool.stats()), ['1.1.1.1:80'])
+        self.assertEqual(self.pool.get(), '1.1.1.1:80')
+        self.pool.report('3.3.3.3:80', False)
+
+
+class TestInsertProxies(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        proxy_engine.set('sqlite:///' + os.path.join(self.tmp_dir, 'proxy.db'))
+        ProxyPool()
+
+    def tearDown(self):
+        proxy_engine.set(PROXY_DB_URL)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_duplicate_ips(self):
+        self.assertEqual(ProxyPool.insert_proxies([{'ip': '1.1.1.1:80', 'is_valid': 0, 'source': 'a'}]), 1)
+        proxies = [
+            {'ip': '1.1.1.1:80', 'is_valid': 1, 'source': 'b'},
+            {'ip': '2.2.2.2:80', 'is_valid': 1, 'source': 'a'},
+            {'ip': '2.2.2.2:80', 'is_valid': 1, 'source': 'b'},
+        ]
+        self.assertEqual(ProxyPool.insert_proxies(proxies), 2)
+        rows = proxy_engine.get().execute('SELECT ip, is_valid, source FROM proxy_ip ORDER BY ip').fetchall()
+        self.assertEqual([tuple(x) for x in rows], [('1.1.1.1:80', 1, 'b'), ('2.2.2.2:80', 1, 'b')])
+
+
+class TestFrontier(OfflineTestCase):
+
+    def test_claim_and_fail(self):
+        frontier = Frontier(crawl_date='2020-07-01', max_attempts=2)
+        self.assertEqual(frontier.seed('sale_info', 'district', ['daxing', 'haidian']), 2)
+        frontier.seed('sale_info', 'district', ['daxing'])
+
+        tasks = frontier.claim(limit=10)
+        self.assertEqual(len(tasks), 2)
+        self.assertEqual(frontier.claim(limit=10), [])
+        frontier.complete(tasks[0])
+        frontier.fail(tasks[1], 'timeout')
+        self.assertEqual(frontier.stats(), {'done': 1, 'pending': 1})
+
+        task, = frontier.claim(limit=10)
+        self.assertEqual(task.attempts, 2)
+        frontier.fail(task, 'timeout')
+        self.assertEqual(frontier.stats(), {'done': 1, 'failed': 1})
+        self.assertEqual(frontier.active(), 0)
+
+    def test_failed_request(self):
+        frontier = Frontier(crawl_date='2020-07-01')
+        frontier.seed('sale_info', 'district', ['daxing'])
+        spider = LianJiaSpider(city="bj", districts=['daxing'])
+        spider.request_fn = lambda url: None
+        while True:
+            tasks = frontier.claim()
+            if not tasks:
+                break
+            spider.crawl_frontier_task(frontier, tasks[0])
+        self.assertEqual(frontier.stats(), {'failed': 1})
+
+    def test_crash_before_write(self):
+        """ 解析后、入库前进程中断：任务不会被标记完成，租约过期后被重新领取 """
+        frontier = Frontier(crawl_date='2020-07-01', lease_seconds=0.1)
+        frontier.seed('sale_info', 'district', ['daxing'])
+        archive = fixture_archive(os.path.join(self.tmp_dir, 'archive'))
+        spider = LianJiaSpider(city="bj", districts=['daxing'])
+        spider.set_replay(archive)
+
+        def killed(module, items):
+            raise KeyboardInterrupt
+        spider.save_records = killed
+        with self.assertRaises(KeyboardInterrupt):
+            spider.crawl_frontier(frontier, max_pages=1)
+        self.assertEqual(frontier.stats(), {'running': 1})
+        self.assertEqual(self.query_all(SaleInfo), [])
+
+        time.sleep(0.2)
+        spider = LianJiaSpider(city="bj", districts=['daxing'])
+        spider.set_replay(archive)
+        spider.crawl_frontier(Frontier(crawl_date='2020-07-01'), max_pages=1)
+        archive.close()
+        self.assertEqual(frontier.stats(), {'done': 1})
+        self.assertEqual(len(self.query_all(SaleInfo)), 2)
+
+    def test_detail_workers(self):
+        spider = LianJiaSpider(city="bj", districts=['daxing'])
+        spider.set_request_params(max_workers=2, delay=0, detail_workers=2)
+        self.assertRaises(ValueError, spider.crawl_frontier, Frontier(crawl_date='2020-07-01'))
+
+
+def list_content(total_pages):
+    return '<html><body><div class="page-box house-lst-page-box" page-data=\'{{"totalPage":{0},"curPage":1}}\'>' \
+           '</div></body></html>'.format(total_pages)
+
+
+class TestSplitQuery(OfflineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.spider = LianJiaSpider(city="bj", districts=['daxing'])
+        self.urls = []
+        self.spider.request_fn = self.request
+
+    def request(self, url):
+        """ 不限条件和价格p3的查询超过上限，p3按面积拆分后每个子查询2页 """
+        self.urls.append(url)
+        if url.endswith('/daxing/pg1/'):
+            return list_content(PAGE_LIMIT)
+        if url.endswith('/daxing/pg1p3/'):
+            return list_content(PAGE_LIMIT + 20)
+        return list_content(2)
+
+    def test_split_filters(self):
+        self.assertEqual(split_filters('sale_info'), ['p{0}'.format(x) for x in range(1, 9)])
+        self.assertEqual(split_filters('sale_info', 'p3')[0], 'p3a1')
+        self.assertEqual(split_filters('transaction_info', 'a1')[0], 'a1l1')
+        self.assertEqual(split_filters('transaction_info', 'a1l2'), [])
+        self.assertEqual(split_filters('community_info'), [])
+
+    def test_split_query(self):
+        queries = self.spider.split_query('sale_info', 'district', 'daxing')
+        expected = [('p{0}'.format(x), 2) for x in range(1, 9) if x != 3]
+        expected[2:2] = [('p3a{0}'.format(x), 2) for x in range(1, 9)]
+        self.assertEqual(queries, expected)
+        self.assertEqual(len(self.urls), 1 + 8 + 8)
+
+        # 已达上限的查询直接拆分，不再查询总页数
+        self.spider.request_fn = lambda url: self.fail(url)
+        self.spider.set_probe_hints(hours=24)
+        self.assertEqual(self.spider.split_query('sale_info', 'district', 'daxing'), expected)
+
+    def test_failed_probe(self):
+        self.spider.request_fn = lambda url: None
+        self.assertEqual(self.spider.split_query('sale_info', 'district', 'daxing'), [])
+        self.assertIsNone(self.spider.hints.get('sale_info', 'district', 'daxing'))
+
+
+class TestFirstPage(OfflineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.archive = fixture_archive(os.path.join(self.tmp_dir, 'archive'))
+        self.spider = LianJiaSpider(city="bj", districts=['daxing'])
+        self.urls = []
+        self.spider.request_fn = self.request
+
+    def tearDown(self):
+        self.archive.close()
+        super().tearDown()
+
+    def request(self, url):
+        self.urls.append(url)
+        return self.archive.read(url)
+
+    def test_reuse_first_page(self):
+        url = "http://bj.lianjia.com/ershoufang/daxing/pg1/"
+        self.assertEqual(self.spider.split_query('sale_info', 'district', 'daxing'), [('', 3)])
+        self.assertIn(url, self.spider.first_pages)
+        self.assertTrue(self.spider.crawl_sale_by_district(('daxing', 1)))
+        self.assertEqual(self.urls.count(url), 1)
+        self.assertEqual(self.spider.first_pages, {})
+        self.assertEqual(len(self.query_all(SaleInfo)), 2)
+
+    def test_probe_hints(self):
+        self.spider.split_query('sale_info', 'district', 'daxing')
+        self.spider.first_pages = {}
+        self.urls = []
+        self.spider.set_probe_hints(hours=24)
+        self.assertEqual(self.spider.split_query('sale_info', 'district', 'daxing'), [('', 3)])
+        self.assertEqual(self.urls, [])
+
+
+class TestTransactionIncremental(OfflineTestCase):
+    """ 成交增量爬取：fixtures中新龙城共3页，每页2条，成交日期依次为2020-11-15、10-15、09-15 """
+
+    def setUp(self):
+        super().setUp()
+        self.archive = fixture_archive(os.path.join(self.tmp_dir, 'archive'))
+        self.urls = []
+        self.broken = {}
+
+    def tearDown(self):
+        self.archive.close()
+        super().tearDown()
+
+    def request(self, url):
+        self.urls.append(url)
+        if url in self.broken:
+            return self.broken[url](self.archive.read(url))
+        return self.archive.read(url)
+
+    def crawl(self):
+        spider = LianJiaSpider(city="bj", districts=[])
+        spider.request_fn = self.request
+        self.urls = []
+        spider.crawl_transaction_incremental('新龙城')
+        return spider
+
+    def pages(self):
+        return [int(re.search(r'pg(\d+)', x).group(1)) for x in self.urls]
+
+    def set_watermark(self, watermark):
+        CrawlHints().save('transaction_info', 'search', '新龙城', '', watermark=watermark)
+
+    def test_first_and_repeated_crawl(self):
+        self.crawl()
+        self.assertEqual(self.pages(), [1, 2, 3])
+        self.assertEqual(len(self.query_all(TransactionInfo)), 6)
+        self.assertEqual(CrawlHints().get_watermark('transaction_info', 'search', '新龙城'), '2020-11-15')
+        self.crawl()
+        self.assertEqual(self.pages(), [1])
+
+    def test_stop_before_lookback(self):
+        self.set_watermark('2020-11-15')
+        self.crawl()
+        # 第2页全部早于 2020-11-15 - 30天，不再请求第3页
+        self.assertEqual(self.pages(), [1, 2])
+        self.assertEqual(sorted(x.deal_date for x in self.query_all(TransactionInfo)),
+                         ['2020-10-15', '2020-10-15', '2020-11-15', '2020-11-15'])
+
+    def assert_failed_page_keeps_watermark(self, broken):
+        self.set_watermark('2020-09-01')
+        self.broken = {'http://bj.lianjia.com/chengjiao/pg2rs新龙城/': broken}
+        self.crawl()
+        hints = CrawlHints().load()
+        self.assertEqual(hints.hint('transaction_info', 'search', '新龙城')['backfill'], 1)
+        self.assertEqual(hints.get_watermark('transaction_info', 'search', '新龙城'), '2020-09-01')
+
+        # 补爬：第1页已入库也继续翻页，爬到水位线日期为止
+        self.broken = {}
+        self.crawl()
+        self.assertEqual(self.pages(), [1, 2, 3])
+        hints = CrawlHints().load()
+        self.assertEqual(hints.hint('transaction_info', 'search', '新龙城')['backfill'], 0)
+        self.assertEqual(hints.get_watermark('transaction_info', 'search', '新龙城'), '2020-11-15')
+        self.assertEqual(len(self.query_all(TransactionInfo)), 6)
+
+    def test_failed_request(self):
+        self.assert_failed_page_keeps_watermark(lambda content: None)
+
+    def test_failed_parse(self):
+        self.assert_failed_page_keeps_watermark(lambda content: content.replace('dealDate', 'date'))
+
+
+class TestDiffPrices(TestCase):
+
+    def test_diff_prices(self):
+        events = diff_prices({'1': 300, '2': 400, '3': 500}, {'2': 400, '3': 480, '4': 600})
+        self.assertEqual(sorted(events), [
+            ('1', 'removed', 300, None), ('3', 'repriced', 500, 480), ('4', 'new', None, 600)])
+        self.assertEqual(diff_prices({}, {}), [])
+
+
+class TestRollup(OfflineTestCase):
+
+    def rollups(self, model, level):
+        return {x.name: x for x in self.query_all(model) if x.level == level}
+
+    def test_rollup_sale(self):
+        crawl_time = datetime.datetime(2020, 7, 26, 8)
+        records = [
+            dict(SALE_RECORD, house_id='1', total_price=300, put_date='2020-07-20'),
+            dict(SALE_RECORD, house_id='2', total_price=400, put_date='2020-01-01'),
+            dict(SALE_RECORD, house_id='3', total_price=500, community='龙腾苑', put_date='2020-07-01'),
+            dict(SALE_RECORD, house_id='3', total_price=600, community='龙腾苑', put_date='2020-07-01'),
+            dict(SALE_RECORD, house_id='4', total_price=900, create_time=crawl_time - datetime.timedelta(days=1)),
+        ]
+        bulk_insert(SaleInfo, [dict(x, create_time=x.get('create_time', crawl_time)) for x in records])
+        for _ in range(2):
+            self.assertEqual(rollup_sale(crawl_time.date()), 4)
+
+        district = self.rollups(SaleRollup, 'district')['昌平']
+        self.assertEqual((district.listing_count, district.total_price_median, district.recent_count),
+                         (3, 400, 2))
+        self.assertEqual(district.recent_total_price_median, 450)
+        communities = self.rollups(SaleRollup, 'community')
+        self.assertEqual({k: x.listing_count for k, x in communities.items()}, {'新龙城': 2, '龙腾苑': 1})
+
+    def test_rollup_transaction(self):
+        upsert(CommunityInfo, [COMMUNITY_RECORD])
+        upsert(TransactionInfo, [
+            {'id': '1_2020-07', 'house_id': '1', 'community': '新龙城', 'deal_date': '2020-07-01',
+             'deal_price': 400, 'put_price': 420, 'deal_period': 30},
+            {'id': '2_2020-07', 'house_id': '2', 'community': '新龙城', 'deal_date': '2020-07-01',
+             'deal_price': 500, 'put_price': 510, 'deal_period': 10},
+            {'id': '3_2020-07', 'house_id': '3', 'community': '新龙城', 'deal_date': '2020-07-02',
+             'deal_price': 300, 'put_price': 300},
+            {'id': '4_2020-06', 'house_id': '4', 'community': '新龙城', 'deal_date': '2020-06-01',
+             'deal_price': 300},
+        ])
+        self.assertEqual(rollup_transaction(datetime.date(2020, 7, 1)), 6)
+        rollups = sorted((x.date.day, x.deal_count, x.deal_price_median, x.price_diff_median, x.deal_period_median)
+                         for x in self.query_all(TransactionRollup) if x.level == 'biz_circle')
+        self.assertEqual(rollups, [(1, 2, 450, 15, 20), (2, 1, 300, 0, None)])
+
+
+class TestExport(OfflineTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.root = os.path.join(self.tmp_dir, 'export')
+        os.makedirs(self.root)
+
+    def exported(self, name):
+        return sorted(pq.read_table(os.path.join(self.root, name)).column('id').to_pylist())
+
+    def test_sale_info_resume(self):
+        bulk_insert(SaleInfo, [dict(SALE_RECORD, house_id=str(x)) for x in range(3)])
+        self.assertEqual(export_table(self.root, 'sale_info', chunk_size=2), 3)
+        self.assertEqual(load_watermarks(self.root)['sale_info']['id'], 3)
+        self.assertEqual(export_table(self.root, 'sale_info'), 0)
+
+        bulk_insert(SaleInfo, [dict(SALE_RECORD, house_id=str(x), create_time=datetime.datetime(2020, 7, 27))
+                               for x in range(2)])
+        self.assertEqual(export_table(self.root, 'sale_info', chunk_size=2), 2)
+        self.assertEqual(self.exported('sale_info'), [1, 2, 3, 4, 5])
+        self.assertTrue(os.path.isdir(os.path.join(self.root, 'sale_info', 'date=2020-07-27')))
+
+    def test_transaction_info_same_create_time(self):
+        create_time = datetime.datetime(2020, 7, 26, 8)
+        records = [{'id': '{0}_2020-07'.format(x), 'house_id': str(x), 'create_time': create_time} for x in range(3)]
+        upsert(TransactionInfo, records[:2])
+        self.assertEqual(export_table(self.root, 'transaction_info', chunk_size=1), 2)
+        self.assertEqual(load_watermarks(self.root)['transaction_info'],
+                         {'id': '1_2020-07', 'create_time': '2020-07-26 08:00:00.000000'})
+
+        # 与水位线create_time相同、id更大的记录仍会导出
+        upsert(TransactionInfo, records[2:])
+        self.assertEqual(export_table(self.root, 'transaction_info'), 1)
+        self.assertEqual(self.exported('transaction_info'), ['0_2020-07', '1_2020-07', '2_2020-07'])
+
+
+class TestMetrics(TestCase):
+
+    def test_prometheus(self):
+        m = Metrics(buckets=(0.1, 1))
+        m.inc('rows_written_total', 2, module='sale_info', key='daxing')
+        m.inc('rows_written_total', module='sale_info', key='daxing')
+        m.observe('parse_seconds', 0.05, stage='list')
+        m.observe('parse_seconds', 0.5, stage='list')
+        m.observe('parse_seconds', 5, stage='list')
+        lines = m.prometheus().splitlines()
+        self.assertEqual(lines, [
+            '# TYPE lianjia_rows_written_total counter',
+            'lianjia_rows_written_total{key="daxing",module="sale_info"} 3',
+            '# TYPE lianjia_parse_seconds histogram',
+            'lianjia_parse_seconds_bucket{stage="list",le="0.1"} 1',
+            'lianjia_parse_seconds_bucket{stage="list",le="1"} 2',
+            'lianjia_parse_seconds_bucket{stage="list",le="+Inf"} 3',
+            'lianjia_parse_seconds_sum{stage="list"} 5.55',
+            'lianjia_parse_seconds_count{stage="list"} 3',
+        ])
+        histogram, = m.report()['histograms']['parse_seconds']
+        self.assertEqual((histogram['count'], histogram['p50'], histogram['p99']), (3, 1, float('inf')))
+
+    def test_label_escape(self):
+        m = Metrics()
+        m.inc('items_parsed_total', key='a"b\\c')
+        self.assertIn('lianjia_items_parsed_total{key="a\\"b\\\\c"} 1', m.prometheus())
+
+    def test_failed_detail_request(self):
+        """ 详情页请求失败只计为请求失败，不计解析失败、不额外降速 """
+        tmp_dir = tempfile.mkdtemp()
+        archive = fixture_archive(tmp_dir)
+        spider = LianJiaSpider(city="bj", districts=['daxing'])
+        spider.request_fn = lambda url: archive.read(url) if 'pg1' in url else None
+        penalized = []
+        spider.penalize = lambda: penalized.append(1)
+        metrics.reset()
+        try:
+            records = spider.crawl_list_page('sale_info', "http://bj.lianjia.com/ershoufang/daxing/pg1/", 'daxing', 1)
+        finally:
+            archive.close()
+            shutil.rmtree(tmp_dir)
+        self.assertEqual(records, [])
+        self.assertEqual(penalized, [])
+        self.assertNotIn('parse_failures_total', metrics.report()['counters'])
@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
-import functools
 import random
+import threading
 import time
+import weakref
+from urllib.parse import urlparse
 
 import requests
 from requests.adapters import HTTPAdapter
 
-from proxy import ProxyPool
+from metrics import metrics
+from proxy import proxy_pool
 from settings import logging
 
 User_Agent = [
@@ -36,55 +39,251 @@ def get_header():
     return {'User-Agent': random.choice(User_Agent)}
 
 
+class SessionManager:
+    """
+    requests.Session连接池管理
+
+    每个线程持有一个Session(shared=False)，或全部线程共享一个Session(shared=True)，
+    keep-alive连接在整个爬取过程中复用；pool_maxsize为每个host的连接数上限，
+    可通过host_pool_sizes为单独的host指定。
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, host_pool_sizes=None, shared=False):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.host_pool_sizes = host_pool_sizes or {}
+        self.shared = shared
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shared_sessions = {}
+        self._sessions = weakref.WeakSet()
+        self._generation = 0
+
+    def configure(self, pool_connections=None, pool_maxsize=None, host_pool_sizes=None, shared=None):
+        """ 修改连接池参数，关闭已有Session(释放其连接池)，各线程在下次使用时重建；应在两次爬取之间调用 """
+        with self._lock:
+            if pool_connections is not None:
+                self.pool_connections = pool_connections
+            if pool_maxsize is not None:
+                self.pool_maxsize = pool_maxsize
+            if host_pool_sizes is not None:
+                self.host_pool_sizes = host_pool_sizes
+            if shared is not None:
+                self.shared = shared
+            sessions, self._sessions = list(self._sessions), weakref.WeakSet()
+            self._shared_sessions = {}
+            self._generation += 1
+        for sess in sessions:
+            sess.close()
+
+    def _build_session(self, retry):
+        sess = requests.Session()
+        for scheme in ('http://', 'https://'):
+            sess.mount(scheme, HTTPAdapter(
+                pool_connections=self.pool_connections,
+                pool_maxsize=self.pool_maxsize,
+                max_retries=retry))
+            for host, pool_size in self.host_pool_sizes.items():
+                sess.mount(scheme + host, HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=pool_size,
+                    max_retries=retry))
+        return sess
+
+    def get_session(self, retry=0):
+        """ 获取当前线程可用的Session """
+        if self.shared:
+            with self._lock:
+                sess = self._shared_sessions.get(retry)
+                if sess is None:
+                    sess = self._shared_sessions[retry] = self._build_session(retry)
+                    self._sessions.add(sess)
+                return sess
+
+        sessions = getattr(self._local, 'sessions', None)
+        if sessions is None or self._local.generation != self._generation:
+            sessions = self._local.sessions = {}
+            self._local.generation = self._generation
+        sess = sessions.get(retry)
+        if sess is None:
+            sess = sessions[retry] = self._build_session(retry)
+            with self._lock:
+                self._sessions.add(sess)
+        return sess
+
+
+session_manager = SessionManager()
+
+
+class RateLimiter:
+    """
+    自适应限速：每个(host, 代理)一个令牌桶，速率按AIMD调整
+
+    请求成功且响应时间低于slow_latency时速率加increase(加性增)，
+    非200、超时、验证码页面或解析失败时速率乘decrease(乘性减)，速率限制在[min_rate, max_rate]。
+    """
+
+    def __init__(self, min_rate=0.1, max_rate=20, increase=0.1, decrease=0.5, slow_latency=3):
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.slow_latency = slow_latency
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, key, initial_rate):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            rate = min(max(initial_rate, self.min_rate), self.max_rate)
+            bucket = self._buckets[key] = {
+                'rate': rate, 'tokens': 1.0, 'updated': time.time(),
+                'success': 0, 'failure': 0, 'last_status': None,
+            }
+        return bucket
+
+    def reserve(self, key, initial_rate):
+        """ 预约一个令牌，返回需要等待的秒数 """
+        with self._lock:
+            bucket = self._bucket(key, initial_rate)
+            now = time.time()
+            capacity = max(1.0, bucket['rate'])
+            bucket['tokens'] = min(capacity, bucket['tokens'] + (now - bucket['updated']) * bucket['rate'])
+            bucket['updated'] = now
+            bucket['tokens'] -= 1
+            return max(0.0, -bucket['tokens'] / bucket['rate'])
+
+    def acquire(self, key, initial_rate):
+        """ 阻塞直到拿到令牌 """
+        wait = self.reserve(key, initial_rate)
+        if wait:
+            time.sleep(wait)
+
+    def feedback(self, key, ok, latency=None, status=None):
+        """ 根据请求结果调整速率 """
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                return
+            bucket['last_status'] = status
+            if ok and (latency is None or latency < self.slow_latency):
+                bucket['success'] += 1
+                bucket['rate'] = min(self.max_rate, bucket['rate'] + self.increase)
+            else:
+                bucket['failure'] += not ok
+                bucket['rate'] = max(self.min_rate, bucket['rate'] * self.decrease)
+
+    def set_rate(self, host, rate):
+        """ 将该host下已有的桶重置为rate，用于修改请求间隔(新建的桶按acquire时的initial_rate) """
+        with self._lock:
+            for key, bucket in self._buckets.items():
+                if key[0] == host:
+                    bucket['rate'] = min(max(rate, self.min_rate), self.max_rate)
+                    bucket['tokens'] = min(bucket['tokens'], 1.0)
+
+    def penalize(self, host):
+        """ 该host下所有桶降速，用于解析失败等请求之外发现的异常 """
+        for key in list(self._buckets):
+            if key[0] == host:
+                self.feedback(key, False, status='penalized')
+
+    def reset(self):
+        with self._lock:
+            self._buckets = {}
+
+    def snapshot(self):
+        """ 当前限速状态，用于监控 """
+        with self._lock:
+            return {'{0}|{1}'.format(*key): {
+                'rate': round(x['rate'], 3),
+                'success': x['success'],
+                'failure': x['failure'],
+                'last_status': x['last_status'],
+            } for key, x in self._buckets.items()}
+
+
+rate_limiter = RateLimiter()
+
+
+def limiter_key(url, proxy=None):
+    return urlparse(url).netloc, proxy or ''
+
+
+def is_blocked(url, content):
+    """ 链家人机验证页面 """
+    return 'captcha' in url or 'hip.lianjia.com' in url or '人机认证' in content
+
+
 def get_proxy():
-    pool = ProxyPool.get_proxy_pool()
-    while pool:
-        proxy = random.choice(pool)
-        if ProxyPool.is_valid_proxy(proxy):
-            return proxy
-        ProxyPool.expire(proxy)
-        pool = ProxyPool.get_proxy_pool()
-    logging.error("@get_proxy Error: no available proxy.")
+    proxy = proxy_pool.get()
+    if not proxy:
+        logging.error("@get_proxy Error: no available proxy.")
+    return proxy
+
+
+def report_proxy(proxy, ok, latency=None):
+    """ 反馈代理的真实请求结果 """
+    if proxy:
+        proxy_pool.report(proxy, ok, latency)
+
+
+def record_request(host, status, latency, size=0):
+    """ 记录请求耗时、状态码和下载字节数 """
+    metrics.observe('request_seconds', latency, host=host, status=status)
+    metrics.inc('request_bytes_total', size, host=host)
 
 
-def request_data(url, retry=0, auto_proxy=False, delay=0, **kwargs):
+def request_data(url, retry=0, auto_proxy=False, delay=0, archive=None, **kwargs):
     """
     Get请求爬取源代码
     :param url: 目标网站
-    :param retry: 是否重试
+    :param retry: 重试次数
     :param auto_proxy: 是否使用代理ip
-    :param delay: 延迟时间
+    :param delay: 初始请求间隔，限速器以1/delay为初始速率(每个host/代理)自适应调整；0为不限速
+    :param archive: HtmlArchive，不为空时存档返回的网页
     :param kwargs: requests.get参数
     :return: text
     """
-    if delay:
-        time.sleep(delay)
-
-    if retry:
-        sess = requests.Session()
-        sess.mount('http://', HTTPAdapter(max_retries=retry))
-        sess.mount('https://', HTTPAdapter(max_retries=retry))
-        method = functools.partial(sess.request, method='get')
-    else:
-        method = requests.get
+    sess = session_manager.get_session(retry)
 
+    proxy = None
     if auto_proxy:
+        with metrics.timer('proxy_select_seconds'):
+            proxy = get_proxy()
         kwargs.update({
-            'proxies': {'http': 'http://{}'.format(get_proxy())}
+            'proxies': {'http': 'http://{}'.format(proxy)}
         })
 
+    key = limiter_key(url, proxy)
+    if delay:
+        with metrics.timer('rate_limit_wait_seconds', host=key[0]):
+            rate_limiter.acquire(key, 1 / delay)
+
+    t0 = time.time()
     try:
-        res = method(
+        res = sess.get(
             url=url,
             headers=get_header(),
             **kwargs)
-        if res.status_code == 200:
+        record_request(key[0], res.status_code, time.time() - t0, len(res.content))
+        if res.status_code == 200 and not is_blocked(res.url, res.text):
             logging.debug("Request Data - {0} - {1}".format(
                 res.status_code, url))
+            rate_limiter.feedback(key, True, time.time() - t0, res.status_code)
+            report_proxy(proxy, True, time.time() - t0)
+            if archive:
+                archive.write(url, res.text)
             return res.text
 
-        logging.info("Request Data - {0} - {1}".format(res.status_code, url))
+        status = 'blocked' if res.status_code == 200 else res.status_code
+        rate_limiter.feedback(key, False, time.time() - t0, status)
+        report_proxy(proxy, False)
+        logging.info("Request Data - {0} - {1}".format(status, url))
     except requests.exceptions.RequestException as e:
+        record_request(key[0], type(e).__name__, time.time() - t0)
+        rate_limiter.feedback(key, False, time.time() - t0, type(e).__name__)
+        report_proxy(proxy, False)
         logging.error("Request ERROR: {0}, url: {1}".format(e, url))
 
 